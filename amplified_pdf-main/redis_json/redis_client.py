@@ -1,9 +1,12 @@
 import json
+import logging
 import math
 import numpy as np
+import os
 import random
 import re
 import redis
+import threading
 import time
 import struct
 import uuid
@@ -15,9 +18,7 @@ from rejson import Client as RejClient, Path
 
 from settings import CONFIG_DATA
 
-LOGGER = object()
-LOGGER.warning = lambda x : print(x)
-LOGGER.info = lambda x : print(x)
+LOGGER = logging.getLogger(__name__)
 
 def np_encoder(object):
     if isinstance(object, np.generic):
@@ -110,20 +111,25 @@ def importer_lock(func):
             return False
     return wrapper
 
+# Cached query results cleared before an import.
+CACHE_PREFIXES = ("hash_keys:", "graphquery:", "ml_cache")
+
 def clear_cache_hash_keys(func):
+    """
+    Invalidate the CACHE_PREFIXES caches before func runs: by bumping their
+    generation numbers when REDIS_INVALIDATE_BY_GENERATION is set (the caches
+    must then build keys with RedisConnection.namespaced_key), otherwise by
+    scanning for and unlinking their keys.
+    """
     def wrapper(*args, **kwargs):
         rc = RedisConnection()
-        cnt_removed = 0
-        clear_prefixes = ["hash_keys:*", "graphquery:*", "ml_cache*"]
-        def remove_starts_with(prefix):
-            existing_keys = rc.get_keys_starting_with(prefix)
-            for k in existing_keys:
-                rc.main.delete(k)
-            return len(existing_keys)
-        for p in clear_prefixes:
-            cnt_removed += remove_starts_with(p)
-        
-        LOGGER.info(":redis_import_hashkeys_clear_before %s dropped %s keys "  %(func.__name__,cnt_removed))
+        if INVALIDATE_BY_GENERATION:
+            generations = [rc.bump_generation(p) for p in CACHE_PREFIXES]
+            LOGGER.info(":redis_import_hashkeys_clear_before %s moved %s to generations %s"
+                        % (func.__name__, CACHE_PREFIXES, generations))
+        else:
+            cnt_removed = sum(rc.invalidate_keys(p + "*") for p in CACHE_PREFIXES)
+            LOGGER.info(":redis_import_hashkeys_clear_before %s dropped %s keys "  %(func.__name__,cnt_removed))
         return func(*args, **kwargs)
     return wrapper
 
@@ -173,6 +179,289 @@ def suppress_redis_bgsave(redis_conn=None, connection_name=None):
     
     return set_bg_save
 
+# Shared connection pools. Every RedisConnection for the same server and
+# credentials reuses one client and its pool, so constructing a connection
+# opens no sockets. The registry is dropped in a forked child (gunicorn
+# workers) so parent and child never share a socket.
+POOL_MAX_CONNECTIONS = int(CONFIG_DATA["REDIS_POOL_MAX_CONNECTIONS"]) if "REDIS_POOL_MAX_CONNECTIONS" in CONFIG_DATA else 50
+POOL_TIMEOUT = float(CONFIG_DATA["REDIS_POOL_TIMEOUT"]) if "REDIS_POOL_TIMEOUT" in CONFIG_DATA else 20
+HEALTH_CHECK_INTERVAL = int(CONFIG_DATA["REDIS_HEALTH_CHECK_INTERVAL"]) if "REDIS_HEALTH_CHECK_INTERVAL" in CONFIG_DATA else 30
+
+_clients = {}
+_routers = {}
+_clients_lock = threading.Lock()
+_clients_pid = os.getpid()
+
+def _reset_clients():
+    """
+    Forget the parent's pools in a forked child. They are not disconnected:
+    the sockets still belong to the parent.
+    """
+    global _clients, _routers, _clients_lock, _clients_pid
+    _clients = {}
+    _routers = {}
+    _clients_lock = threading.Lock()
+    _clients_pid = os.getpid()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_clients)
+
+def shared_client(host, port, username=None, password=None, decode_responses=True, **kwargs):
+    """
+    The process-wide RejClient for a server, backed by a blocking pool of at most
+    POOL_MAX_CONNECTIONS connections that are health checked when idle for
+    HEALTH_CHECK_INTERVAL seconds.
+    """
+    if os.getpid() != _clients_pid:
+        _reset_clients()
+    key = (host, int(port), username, password, decode_responses, tuple(sorted(kwargs.items())))
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                kwargs.setdefault("max_connections", POOL_MAX_CONNECTIONS)
+                kwargs.setdefault("timeout", POOL_TIMEOUT)
+                kwargs.setdefault("health_check_interval", HEALTH_CHECK_INTERVAL)
+                pool = redis.BlockingConnectionPool(
+                    host=host,
+                    port=int(port),
+                    username=username,
+                    password=password,
+                    decode_responses=decode_responses,
+                    **kwargs)
+                client = RejClient(connection_pool=pool, decode_responses=decode_responses)
+                _clients[key] = client
+    return client
+
+def disconnect_shared_clients():
+    """
+    Close every pooled connection of this process (e.g. at shutdown).
+    """
+    with _clients_lock:
+        for client in _clients.values():
+            client.connection_pool.disconnect()
+        _clients.clear()
+        _routers.clear()
+
+# Replica reads. Every read goes to the healthy replica with the lowest
+# (requests in flight + 1) * moving average latency; a replica that fails is
+# ejected for a cooldown and the read retried on the next one, and with no
+# healthy replica left reads go to main.
+EJECT_SECONDS = float(CONFIG_DATA["REDIS_REPLICA_EJECT_SECONDS"]) if "REDIS_REPLICA_EJECT_SECONDS" in CONFIG_DATA else 10
+READ_YOUR_WRITES_SECONDS = float(CONFIG_DATA["REDIS_READ_YOUR_WRITES_SECONDS"]) if "REDIS_READ_YOUR_WRITES_SECONDS" in CONFIG_DATA else 2
+LATENCY_ALPHA = 0.2
+PROBE_RATE = 0.05
+READ_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+# Commands returning a lazy iterator; see ReplicaRouter.iterate.
+ITERATOR_COMMANDS = ("scan_iter", "sscan_iter", "hscan_iter", "zscan_iter")
+
+class ReplicaRouter(object):
+    """
+    Spreads reads over a set of replica clients, falling back to main.
+    Shared by every RedisConnection to the same servers (see shared_router).
+    """
+
+    def __init__(self, replicas, main):
+        self.names = [name for name, _ in replicas]
+        self.clients = [client for _, client in replicas]
+        self.main = main
+        self.outstanding = [0] * len(self.clients)
+        self.latency = [0.0] * len(self.clients)
+        self.ejected_until = [0.0] * len(self.clients)
+        self.lock = threading.Lock()
+
+    def order(self):
+        """
+        Indexes of the healthy replicas, best first. Now and then a random one
+        goes first so that a replica that was slow once gets measured again.
+        """
+        now = time.monotonic()
+        with self.lock:
+            healthy = [i for i in range(len(self.clients)) if self.ejected_until[i] <= now]
+            healthy.sort(key=lambda i: (self.outstanding[i] + 1) * self.latency[i])
+        if len(healthy) > 1 and random.random() < PROBE_RATE:
+            healthy.insert(0, healthy.pop(random.randrange(1, len(healthy))))
+        return healthy
+
+    def call(self, command, *args, **kwargs):
+        for i in self.order():
+            with self.lock:
+                self.outstanding[i] += 1
+            started = time.monotonic()
+            try:
+                result = getattr(self.clients[i], command)(*args, **kwargs)
+            except READ_ERRORS as err:
+                self.eject(i, err)
+                continue
+            finally:
+                with self.lock:
+                    self.outstanding[i] -= 1
+            self.observe(i, time.monotonic() - started)
+            return result
+        return getattr(self.main, command)(*args, **kwargs)
+
+    def iterate(self, command, *args, **kwargs):
+        """
+        Yield from an iterator command such as scan_iter, driven to the end on one
+        replica. A replica that fails part way through is ejected and the iteration
+        restarted on the next one (then main), skipping items already yielded. Not
+        timed: how long a scan takes says nothing about a replica's latency.
+        """
+        seen = set()
+        for i in self.order():
+            with self.lock:
+                self.outstanding[i] += 1
+            try:
+                for item in getattr(self.clients[i], command)(*args, **kwargs):
+                    if item not in seen:
+                        seen.add(item)
+                        yield item
+                return
+            except READ_ERRORS as err:
+                self.eject(i, err)
+            finally:
+                with self.lock:
+                    self.outstanding[i] -= 1
+        for item in getattr(self.main, command)(*args, **kwargs):
+            if item not in seen:
+                yield item
+
+    def client(self):
+        """
+        The client the next read would go to.
+        """
+        healthy = self.order()
+        return self.clients[healthy[0]] if healthy else self.main
+
+    def observe(self, i, seconds):
+        with self.lock:
+            if self.latency[i]:
+                self.latency[i] += LATENCY_ALPHA * (seconds - self.latency[i])
+            else:
+                self.latency[i] = seconds
+
+    def eject(self, i, err):
+        with self.lock:
+            self.ejected_until[i] = time.monotonic() + EJECT_SECONDS
+            self.latency[i] = 0.0
+        LOGGER.warning("Replica %s ejected for %ss: %s" % (self.names[i], EJECT_SECONDS, err))
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return [{"replica": name, "outstanding": self.outstanding[i], "latency": self.latency[i],
+                     "ejected": self.ejected_until[i] > now} for i, name in enumerate(self.names)]
+
+def shared_router(replica_parts, main, **client_kwargs):
+    """
+    The process-wide ReplicaRouter for a list of [host, port] replicas.
+    """
+    if os.getpid() != _clients_pid:
+        _reset_clients()
+    # main is itself a registry client, so its id is stable for the process.
+    key = (tuple(tuple(parts) for parts in replica_parts), id(main))
+    router = _routers.get(key)
+    if router is None:
+        replicas = [("%s:%s" % (host, port), shared_client(host, port, **client_kwargs))
+                    for host, port in replica_parts]
+        with _clients_lock:
+            router = _routers.setdefault(key, ReplicaRouter(replicas, main))
+    return router
+
+class WrittenKeys(object):
+    """
+    Keys written through main in the last READ_YOUR_WRITES_SECONDS. Commands
+    without a single key (pipelines, multi-key deletes) mark every key.
+    """
+    ALL = object()
+
+    def __init__(self, seconds=READ_YOUR_WRITES_SECONDS):
+        self.seconds = seconds
+        self.until = {}
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        now = time.monotonic()
+        with self.lock:
+            if len(self.until) > 1024:
+                self.until = {k: t for k, t in self.until.items() if t > now}
+            self.until[key] = now + self.seconds
+
+    def recent(self, key):
+        now = time.monotonic()
+        with self.lock:
+            return self.until.get(self.ALL, 0) > now or self.until.get(key, 0) > now
+
+class TrackedMain(object):
+    """
+    Main client that records the keys it writes in a WrittenKeys.
+    """
+
+    def __init__(self, client, written):
+        self.client = client
+        self.written = written
+
+    def __getattr__(self, command):
+        attr = getattr(self.client, command)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            if command in ("delete", "unlink"):
+                keys = args
+            elif command != "pipeline" and args and isinstance(args[0], str):
+                keys = args[:1]
+            else:
+                keys = (WrittenKeys.ALL,)
+            for key in keys:
+                self.written.add(key)
+            return attr(*args, **kwargs)
+        return call
+
+class RoutedReads(object):
+    """
+    Stands in for a replica client: each command is sent through the router,
+    or to main when read-your-writes is on and the key was just written.
+    """
+
+    def __init__(self, router, written=None):
+        self.router = router
+        self.written = written
+
+    def __getattr__(self, command):
+        attr = getattr(self.router.client(), command)
+        if not callable(attr):
+            return attr
+        route = self.router.iterate if command in ITERATOR_COMMANDS else self.router.call
+        def call(*args, **kwargs):
+            if self.written is not None and self.written.recent(args[0] if args else None):
+                return getattr(self.router.main, command)(*args, **kwargs)
+            return route(command, *args, **kwargs)
+        return call
+
+# Bulk writes: values are sent BULK_CHUNK_SIZE at a time in one variadic
+# command, and up to PIPELINE_MAX_COMMANDS of those per pipeline round trip.
+BULK_CHUNK_SIZE = int(CONFIG_DATA["REDIS_BULK_CHUNK_SIZE"]) if "REDIS_BULK_CHUNK_SIZE" in CONFIG_DATA else 1000
+PIPELINE_MAX_COMMANDS = int(CONFIG_DATA["REDIS_PIPELINE_MAX_COMMANDS"]) if "REDIS_PIPELINE_MAX_COMMANDS" in CONFIG_DATA else 100
+
+# Invalidation: keys are found with SCAN (COUNT SCAN_COUNT per call, so the
+# server is never blocked the way KEYS blocks it) and removed with pipelined
+# UNLINKs of UNLINK_KEYS keys, UNLINK_BATCH keys per round trip.
+SCAN_COUNT = int(CONFIG_DATA["REDIS_SCAN_COUNT"]) if "REDIS_SCAN_COUNT" in CONFIG_DATA else 1000
+UNLINK_BATCH = int(CONFIG_DATA["REDIS_UNLINK_BATCH"]) if "REDIS_UNLINK_BATCH" in CONFIG_DATA else 1000
+UNLINK_KEYS = 100
+INVALIDATE_BY_GENERATION = str(CONFIG_DATA["REDIS_INVALIDATE_BY_GENERATION"]).lower() in ("1", "true", "yes") if "REDIS_INVALIDATE_BY_GENERATION" in CONFIG_DATA else False
+# set_np_array header: rows, columns and the dtype string (e.g. "<f4").
+NP_ARRAY_HEADER = ">II8s"
+NP_ARRAY_HEADER_SIZE = struct.calcsize(NP_ARRAY_HEADER)
+
+# sanitize_json_key patterns. A-z (not A-Z) is deliberate: keys already stored
+# were sanitized with it, so it must keep [ \ ] ^ and ` as they were.
+NON_VALID_JSON_KEY_VALUES_REGEX = re.compile("[^a-zA-z0-9_$]")
+# negative look ahead -- if the passed in key already starts with _ or $,
+# skip adding the default _
+NON_VALID_STARTS_WITH = re.compile("^(?![_$])")
+
 class RedisConnection(object):
     """
     A connection to the redis server.
@@ -189,19 +478,17 @@ class RedisConnection(object):
         # They can only start with letters, $, or _ characters. If the string
         # passed in doesn't start with one these, making the executive decision
         # to start it with an underscore, even if string starts with a letter.
-        NON_VALID_JSON_KEY_VALUES_REGEX = re.compile("[^a-zA-z0-9_$]")
-        # negative look ahead -- if the passed in key already starts with _ or $,
-        # skip adding the default _
-        NON_VALID_STARTS_WITH = re.compile("^(?![_$])")
-
-        new_key = re.sub(NON_VALID_JSON_KEY_VALUES_REGEX, "__", key)
-        if re.match(NON_VALID_STARTS_WITH, new_key):
+        new_key = NON_VALID_JSON_KEY_VALUES_REGEX.sub("__", key)
+        if NON_VALID_STARTS_WITH.match(new_key):
             new_key = "_%s" % new_key
         return "%s" % new_key
 
-    def __init__(self, decode_responses=True, main_uri=None, replica_uri=None, **kwargs):
+    def __init__(self, decode_responses=True, main_uri=None, replica_uri=None, read_your_writes=False, **kwargs):
         """
-        Creates a connection to redis using "redis_servers" from config provider
+        Creates a connection to redis using "redis_servers" from config provider.
+        Reads are spread over every replica by the shared ReplicaRouter; with
+        read_your_writes, reads of a key written through this connection's main
+        in the last READ_YOUR_WRITES_SECONDS go to main.
         """
         if not "REDIS_REPLICAS" in CONFIG_DATA and not replica_uri:
             raise KeyError("REDIS_REPLICAS not found in config")
@@ -218,50 +505,51 @@ class RedisConnection(object):
         self.replica_parts = []
         self.main_parts = []
         if isinstance(replicas, list):
-            ri = random.choice(range(0,len(replicas)))
-            self.replica_parts = replicas[ri].split(':')
+            self.replica_parts = [r.split(':') for r in replicas if r]
         elif replicas and isinstance(replicas, str):
-            self.replica_parts = replicas.split(":")
+            self.replica_parts = [replicas.split(":")]
 
         if isinstance(main, list):
             # if we have a list of main instances just take the first one provided
             main = main[0]
         if isinstance(main, str):
             self.main_parts = main.split(':')
-            
-        if self.replica_parts:
-            self.replica = RejClient(
-                        host=self.replica_parts[0], 
-                        port=self.replica_parts[1],
-                        username=username,
-                        password=password,
-                        decode_responses=decode_responses,  
-                        **kwargs)
-            if not self.replica:
-                raise ConnectionError("unalbe to create replica connection to %s: %s" % (self.replica_parts[0], self.replica_parts[1]))
-        else:
-            raise ValueError("no valid redis replica uri found.")
+
         if self.main_parts:
-            self.main = RejClient(
-                    host=self.main_parts[0], 
-                    port=self.main_parts[1], 
+            main_client = shared_client(
+                    self.main_parts[0],
+                    self.main_parts[1],
                     password=password,
                     username=username,
-                    decode_responses=decode_responses, 
+                    decode_responses=decode_responses,
                     **kwargs)
-            if not self.main:
+            if not main_client:
                 raise ConnectionError("unalbe to create main connection to %s: %s" % (self.main_parts[0], self.main_parts[1]))
         else:
             raise ValueError("no valid redis main uri found.")
             #LOGGER.info("Master server  %s:%s", main_parts[0], main_parts[1])
+        if self.replica_parts:
+            self.router = shared_router(
+                        self.replica_parts,
+                        main_client,
+                        username=username,
+                        password=password,
+                        decode_responses=decode_responses,
+                        **kwargs)
+        else:
+            raise ValueError("no valid redis replica uri found.")
+
+        written = WrittenKeys() if read_your_writes else None
+        self.main = TrackedMain(main_client, written) if read_your_writes else main_client
+        self.replica = RoutedReads(self.router, written)
         self.decode_responses=decode_responses
 
-    def add_list(self, key, values):
+    def add_list(self, key, values, transaction=False):
         """
         Create a list and add values or just append the values if the list already exists
         """
-        for v in reversed(values):
-            self.main.lpush(key, v)
+        # values[0] ends up at the head, as with one LPUSH per value in reverse.
+        self.bulk("lpush", key, list(reversed(values)), transaction=transaction)
         return True
 
     def add_to_set(self, set_name, value):
@@ -270,19 +558,42 @@ class RedisConnection(object):
         """
         return self.main.sadd(set_name, value)
 
-    def add_values_to_set(self, set_name, values):
+    def add_values_to_set(self, set_name, values, transaction=True):
         """
         add multiple values to a set.
         """
         try:
-            pipeline = self.main.pipeline(transaction=True)
-            for v in values:
-                pipeline.sadd(set_name, v)
-            pipeline.execute()
+            self.bulk("sadd", set_name, values, transaction=transaction)
             return True
         except Exception as err:
             LOGGER.error(err, err.__str__)
 
+    def bulk(self, command, key, values, *args, transaction=False, chunk_size=None):
+        """
+        Send command(key, *args, *chunk) to main for every chunk_size (default
+        BULK_CHUNK_SIZE) values, PIPELINE_MAX_COMMANDS commands per round trip, and
+        return the replies in order. With transaction each round trip is a MULTI/EXEC,
+        so a load of more than chunk_size * PIPELINE_MAX_COMMANDS values is not atomic.
+        """
+        values = list(values)
+        chunk_size = chunk_size or BULK_CHUNK_SIZE
+        chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+        replies = []
+        for start in range(0, len(chunks), PIPELINE_MAX_COMMANDS):
+            pipeline = self.main.pipeline(transaction=transaction)
+            for chunk in chunks[start:start + PIPELINE_MAX_COMMANDS]:
+                getattr(pipeline, command)(key, *args, *chunk)
+            replies.extend(pipeline.execute())
+        return replies
+
+    def bump_generation(self, prefix):
+        """
+        Invalidate every key made with namespaced_key(prefix, ...) at once by
+        moving prefix to a new generation; returns the new generation number.
+        Keys of older generations are never read again and should carry a TTL.
+        """
+        return self.main.incr("gen:" + prefix)
+
     def config_get(self, key):
         return self.main.config_get(key)
 
@@ -293,17 +604,10 @@ class RedisConnection(object):
         return self.main.delete(key)
 
     def del_keys_by_filter(self, filter=""):
-        result = 0
         if filter:
-            keys = self.get_keys(filter)
-            if keys:
-                for key in keys:
-                    result += self.main.delete(key)
-                    if result:
-                        LOGGER.info("Dropped cache key: %s", key)
-                    else:
-                        LOGGER.info("Failed to drop key %s", key)
-                return result
+            result = self.invalidate_keys(filter)
+            LOGGER.info("Dropped %s cache keys matching %s", result, filter)
+            return result
 
     def del_json_value(self, base, path=Path.rootPath()):
         return self.main.jsondel(base, path)
@@ -336,9 +640,16 @@ class RedisConnection(object):
         return None
 
     def get_keys_starting_with(self, key_prefix):
-        iter_keys = self.replica.scan_iter(key_prefix)
+        iter_keys = self.replica.scan_iter(key_prefix, count=SCAN_COUNT)
         return list(iter_keys)
 
+    def get_generation(self, prefix):
+        """
+        Current generation number of prefix (0 until the first bump_generation).
+        Read from main, so a key is never built under a generation already bumped.
+        """
+        return int(self.main.get("gen:" + prefix) or 0)
+
     def get_in_set(self, set_name, value):
         """
         True if value exists set_name
@@ -388,12 +699,13 @@ class RedisConnection(object):
         return self.replica.hget(hash_name, key_name)
 
     def get_keys(self, key_filter="*"):
-        result = self.replica.keys(key_filter)
+        # SCAN may return a key more than once.
+        result = list(dict.fromkeys(self.replica.scan_iter(match=key_filter, count=SCAN_COUNT)))
         return result
 
     def get_key_exists(self, key_filter="*"):
-        keys = self.get_keys(key_filter)
-        return True if keys else False
+        keys = self.replica.scan_iter(match=key_filter, count=SCAN_COUNT)
+        return next(iter(keys), None) is not None
 
     def get_list(self, key):
         """
@@ -406,17 +718,72 @@ class RedisConnection(object):
         return None
 
     def get_np_array(self, key):
+        """
+        Read an array stored by set_np_array, with the dtype it was stored with.
+        Needs a connection made with decode_responses=False, as the value is binary.
+        Returns None if the key does not exist.
+        """
+        if self.decode_responses:
+            raise ValueError("get_np_array needs RedisConnection(decode_responses=False)")
         encoded = self.replica.get(key)
-        h, w = struct.unpack(">II", encoded[:8])
-        a = np.frombuffer(encoded, dtype=np.numeric, offset=8).reshape(h,w)
+        if encoded is None:
+            return None
+        h, w, dtype = struct.unpack(NP_ARRAY_HEADER, encoded[:NP_ARRAY_HEADER_SIZE])
+        a = np.frombuffer(encoded, dtype=np.dtype(dtype.rstrip(b"\0").decode()),
+                          offset=NP_ARRAY_HEADER_SIZE).reshape(h,w)
         return a
 
+    def invalidate_keys(self, match, count=None, batch_size=None, progress=None):
+        """
+        Delete every key matching the glob-style pattern match without blocking the
+        server: SCAN main with COUNT count (default SCAN_COUNT) and UNLINK the keys
+        found every batch_size (default UNLINK_BATCH) keys. progress(scanned, deleted)
+        is called after each batch. Returns the number of keys deleted.
+        """
+        batch_size = batch_size or UNLINK_BATCH
+        scanned = deleted = 0
+        batch = []
+        for key in self.main.scan_iter(match=match, count=count or SCAN_COUNT):
+            batch.append(key)
+            scanned += 1
+            if len(batch) >= batch_size:
+                deleted += self._unlink(batch)
+                batch = []
+                if progress:
+                    progress(scanned, deleted)
+        if batch:
+            deleted += self._unlink(batch)
+            if progress:
+                progress(scanned, deleted)
+        return deleted
+
+    def _unlink(self, keys):
+        # UNLINK frees values in the background; servers before 4.0 only have DEL.
+        keys = list(dict.fromkeys(keys))
+        for command in ("unlink", "delete"):
+            pipeline = self.main.pipeline(transaction=False)
+            for i in range(0, len(keys), UNLINK_KEYS):
+                getattr(pipeline, command)(*keys[i:i + UNLINK_KEYS])
+            try:
+                return sum(pipeline.execute())
+            except ResponseError as err:
+                if command != "unlink" or "unknown command" not in str(err).lower():
+                    raise
+        return 0
+
     def key_exist(self, key_name):
         """
         Check if key_name exists.
         """
         return self.replica.exists(key_name) 
 
+    def namespaced_key(self, prefix, key):
+        """
+        key under the current generation of prefix, e.g. "hash_keys:3:<key>";
+        see bump_generation.
+        """
+        return "%s%s:%s" % (prefix, self.get_generation(prefix), key)
+
     def pop_set(self, set_name, count=1):
         return self.main.spop(set_name, count)
 
@@ -427,12 +794,9 @@ class RedisConnection(object):
         # return self.main.srem(set_name, values)
         return self.remove_values_from_set(set_name, values)
     
-    def remove_values_from_set(self, set_name, values):
+    def remove_values_from_set(self, set_name, values, transaction=True):
         try: 
-            pipeline = self.main.pipeline(transaction=True)
-            for v in values:
-                pipeline.srem(set_name, v)
-            pipeline.execute()
+            self.bulk("srem", set_name, values, transaction=transaction)
             return True
         except Exception as err:
             LOGGER.error(err, err.__doc__)
@@ -454,15 +818,32 @@ class RedisConnection(object):
         """
         Save the value under the key name (key) at the redis cache location (base)
         """
-        #rej_client = RejClient(host=self.main_parts[0], port=self.main_parts[1], decode_responses=True)
-        # check for and handle missing base ke
-        existing_base = self.get_keys_starting_with(base)
-        if not existing_base:
-            self.main.jsonset(base, Path.rootPath(), {"created":time.time()})
-        if not key:
-            key = Path.rootPath()
-        ret_val = self.main.jsonset(base, key, value)
-        return ret_val
+        return self.set_json_values([(base, key, value)], transaction=True)[0]
+
+    def set_json_values(self, updates, transaction=False):
+        """
+        Apply (base, key, value) updates in order, BULK_CHUNK_SIZE per pipeline round
+        trip, and return each jsonset result. A missing base is created first as
+        {"created": <time>} with JSONSET NX, so no existence check is needed.
+        """
+        results = []
+        created = set()
+        updates = list(updates)
+        for start in range(0, len(updates), BULK_CHUNK_SIZE):
+            pipeline = self.main.pipeline(transaction=transaction)
+            queued = 0
+            positions = []
+            for base, key, value in updates[start:start + BULK_CHUNK_SIZE]:
+                if base not in created:
+                    pipeline.jsonset(base, Path.rootPath(), {"created": time.time()}, nx=True)
+                    created.add(base)
+                    queued += 1
+                pipeline.jsonset(base, key or Path.rootPath(), value)
+                positions.append(queued)
+                queued += 1
+            replies = pipeline.execute()
+            results.extend(replies[i] for i in positions)
+        return results
 
     def set_hash_values (self, key, d_values):
         """
@@ -499,19 +880,27 @@ class RedisConnection(object):
 
     def set_np_array(self, key,  np_array_numeric):
         """
-        Convert a numpy numeric array to bytes and store in the key provided
+        Convert a numpy numeric array to bytes and store in the key provided,
+        after a header holding its shape and dtype (see get_np_array)
         """
         h, w = np_array_numeric.shape
-        shape = struct.pack(">II", h, w)
-        encoded = shape + np_array_numeric.tobyes()
+        shape = struct.pack(NP_ARRAY_HEADER, h, w, np_array_numeric.dtype.str.encode())
+        encoded = shape + np_array_numeric.tobytes()
         self.main.set(key, encoded)
         return 1
 
     def x_ack(self, stream_name, group_name, l_ids):
-        results = {}
-        for id in l_ids:
-            results[id] = self.main.xack(stream_name, group_name, id)
-        return results
+        """
+        Acknowledge l_ids; returns {id: 1 if it was pending else 0}.
+        """
+        l_ids = list(l_ids)
+        return dict(zip(l_ids, self.bulk("xack", stream_name, l_ids, group_name, chunk_size=1)))
+
+    def x_ack_all(self, stream_name, group_name, l_ids):
+        """
+        Acknowledge l_ids with variadic XACKs; returns how many were pending.
+        """
+        return sum(self.bulk("xack", stream_name, l_ids, group_name))
 
     def x_add(self, stream_name, d_values):
         if d_values is None:
@@ -1,42 +1,80 @@
+import gzip
+import hashlib
 import os
 import sqlite3
-from flask import Flask, render_template, request, flash, redirect, url_for, session
+from flask import (Flask, Response, render_template, stream_template, request, flash,
+                   redirect, url_for, session, abort, jsonify, send_file, send_from_directory)
+from markupsafe import Markup
+
+import autocomplete
+import bundles
+import concordance
+import corpus
+import daily_verse
+import db
+import export
+import fuzzy
+import metrics
+import positions
+import references
+import related
+from http_cache import CORPUS_MAX_AGE, IMMUTABLE_MAX_AGE, corpus_build, corpus_cached
+import render_cache
+import search as verse_search
+import vocabulary
 
 app = Flask(__name__)
 app.secret_key = "supersecretkey"
 
+VERSES_PAGE_SIZE = 200
+VERSES_MAX_PAGE_SIZE = 1000
+
 # ---------------------------
 # Database initialization
 # ---------------------------
 def init_db():
-    conn = sqlite3.connect("app.db")
-    cur = conn.cursor()
-
-    # Verses table
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS verses (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        book TEXT,
-        chapter INTEGER,
-        verse INTEGER,
-        text TEXT,
-        translation TEXT
-    )
-    """)
-
-    # Users table
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        email TEXT UNIQUE,
-        credits INTEGER DEFAULT 0
-    )
-    """)
-
-    conn.commit()
+    conn = sqlite3.connect(db.DATABASE)
+    db.init_db(conn)
+    conn.close()
+
+    # Empty corpus schema until ingest.py loads the translations
+    conn = sqlite3.connect(db.CORPUS_DATABASE)
+    db.init_corpus_db(conn)
     conn.close()
 
+# ---------------------------
+# Rendered page cache
+# ---------------------------
+def make_page_cache():
+    # RENDER_CACHE_L2 = "sqlite:<path>" shares renders through a SQLite file,
+    # "redis" through RedisConnection (amplified_pdf-main/redis_json on the path).
+    spec = os.environ.get("RENDER_CACHE_L2", "")
+    l2 = None
+    if spec.startswith("sqlite:"):
+        l2 = render_cache.SQLiteStore(spec[len("sqlite:"):])
+    elif spec == "redis":
+        from redis_client import RedisConnection
+        l2 = render_cache.RedisStore(RedisConnection())
+    max_bytes = int(os.environ.get("RENDER_CACHE_MAX_BYTES", render_cache.DEFAULT_MAX_BYTES))
+    return render_cache.RenderCache(max_bytes, l2)
+
+page_cache = make_page_cache()
+metrics.init_app(app, cache_stats=page_cache.stats)
+daily = daily_verse.DailyVerse()
+
+def render_cached(template, key, context):
+    # context() is only called (and the corpus only read) on a cache miss.
+    build_hash, _ = corpus_build()
+    if not build_hash or session.get("_flashes"):
+        return render_template(template, **context())
+    page_cache.set_build(build_hash)
+    parts = (template, "user" if "user_id" in session else "anon") + tuple(key)
+    html = page_cache.get(parts)
+    if html is None:
+        html = render_template(template, **context())
+        page_cache.put(parts, html)
+    return html
+
 # ---------------------------
 # Routes
 # ---------------------------
@@ -50,18 +88,438 @@ def home():
     return render_template("home.html")
 
 @app.route("/verse/<translation>")
+@corpus_cached(daily=True)
 def verse(translation):
-    daily = f"Daily verse placeholder for {translation}"
-    return render_template("verse.html", translation=translation, daily=daily)
+    verse_id, text = daily.get(translation)
+    return render_template("verse.html", translation=translation, verse=text,
+                           verse_id=verse_id, user_id=session.get("user_id"))
 
 @app.route("/verses/<translation>")
+@corpus_cached()
 def verses(translation):
-    conn = sqlite3.connect("app.db")
-    cur = conn.cursor()
-    cur.execute("SELECT book, chapter, verse, text, translation FROM verses WHERE translation = ?", (translation,))
-    all_verses = cur.fetchall()
-    conn.close()
-    return render_template("verses.html", translation=translation, verses=all_verses)
+    # ?stream=1 sends the whole translation as rows come off the cursor;
+    # otherwise pages are keyed on the last verse id seen (?after=<verse_id>).
+    if request.args.get("stream"):
+        return Response(stream_template(
+            "verses.html", translation=translation,
+            verses=_stream_verses(translation), streamed=True))
+
+    after = request.args.get("after", 0, type=int)
+    limit = min(max(request.args.get("limit", VERSES_PAGE_SIZE, type=int), 1), VERSES_MAX_PAGE_SIZE)
+
+    def context():
+        rows = db.get_corpus_db().execute(
+            "SELECT verse_id, book, chapter, verse, text, translation FROM verses "
+            "WHERE translation = ? AND verse_id > ? ORDER BY verse_id LIMIT ?",
+            (translation, after, limit + 1)).fetchall()
+        next_after = rows[limit - 1][0] if len(rows) > limit else None
+        page = [row[1:] for row in rows[:limit]]
+        return dict(translation=translation, verses=page, next_after=next_after, limit=limit)
+
+    return render_cached("verses.html", (translation, None, None, after, limit), context)
+
+def _stream_verses(translation):
+    cur = db.get_corpus_db().cursor()
+    try:
+        cur.arraysize = 500
+        cur.execute(
+            "SELECT book, chapter, verse, text, translation FROM verses "
+            "WHERE translation = ? ORDER BY verse_id", (translation,))
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cur.close()
+
+def read_range(translation, start, end, limit=None):
+    # Served from the memory-mapped corpus file when one has been built.
+    mapped = corpus.open_corpus(translation)
+    if mapped is not None:
+        return list(mapped.range(start, end, limit))
+    return db.read_range(db.get_corpus_db(), translation, start, end, limit).fetchall()
+
+def chapter_count(translation, book):
+    start, end = db.pack_verse_id(book, 0, 0), db.pack_verse_id(book, 999, 999)
+    mapped = corpus.open_corpus(translation)
+    if mapped is not None:
+        last = mapped.last_verse_id(start, end)
+    else:
+        last = db.last_verse_id(db.get_corpus_db(), translation, start, end)
+    return db.unpack_verse_id(last)[1] if last else 0
+
+@app.route("/verses/<translation>/<book>/<int:chapter>")
+@corpus_cached()
+def chapter(translation, book, chapter):
+    b = db.book_id(book)
+    if b is None:
+        abort(404)
+
+    def context():
+        mapped = corpus.open_corpus(translation)
+        if mapped is not None:
+            rows = mapped.chapter(b, chapter)
+        else:
+            rows = read_range(translation, *db.chapter_bounds(b, chapter))
+        if not rows:
+            abort(404)
+        return dict(translation=translation, book=db.BOOK_NAMES[b], book_id=b, chapter=chapter, verses=rows,
+                    chapters=chapter_count(translation, b))
+
+    return render_cached("chapter.html", (translation, b, chapter, None), context)
+
+@app.route("/api/verses/<translation>/<int:start>-<int:end>")
+@corpus_cached()
+def verse_range(translation, start, end):
+    # e.g. /api/verses/KJV/01001001-02001005 is Genesis 1:1 through Exodus 1:5
+    if end < start:
+        abort(400)
+    rows = read_range(translation, start, end, limit=VERSES_MAX_PAGE_SIZE + 1)
+    next_start = rows[-1][0] if len(rows) > VERSES_MAX_PAGE_SIZE else None
+    return jsonify({
+        "translation": translation,
+        "start": db.format_verse_id(start),
+        "end": db.format_verse_id(end),
+        "next": db.format_verse_id(next_start) if next_start else None,
+        "verses": [
+            {"id": db.format_verse_id(vid), "book": book, "chapter": ch, "verse": v, "text": text}
+            for vid, book, ch, v, text in rows[:VERSES_MAX_PAGE_SIZE]
+        ],
+    })
+
+@app.route("/api/verse/<translation>/<int:verse_id>")
+@corpus_cached()
+def verse_by_id(translation, verse_id):
+    mapped = corpus.open_corpus(translation)
+    if mapped is not None:
+        row = mapped.verse(verse_id)
+    else:
+        rows = read_range(translation, verse_id, verse_id)
+        row = rows[0] if rows else None
+    if row is None:
+        abort(404)
+    vid, book, ch, v, text = row
+    return jsonify({"translation": translation, "id": db.format_verse_id(vid),
+                    "book": book, "chapter": ch, "verse": v, "text": text})
+
+@app.route("/api/related/<translation>/<int:verse_id>")
+@corpus_cached()
+def related_verses(translation, verse_id):
+    # Precomputed by related.py; ?limit= up to the k it was run with.
+    rel = related.open_related(translation)
+    if rel is None:
+        abort(404)
+    found = rel.related(verse_id, request.args.get("limit", type=int))
+    if found is None:
+        abort(404)
+    mapped = corpus.open_corpus(translation)
+    verses = []
+    for vid, score in found:
+        if mapped is not None:
+            row = mapped.verse(vid)
+        else:
+            rows = read_range(translation, vid, vid)
+            row = rows[0] if rows else None
+        if row is None:
+            continue
+        _, book, ch, v, text = row
+        verses.append({"id": db.format_verse_id(vid), "book": book, "chapter": ch, "verse": v,
+                       "text": text, "score": round(score, 4)})
+    return jsonify({"translation": translation, "id": db.format_verse_id(verse_id), "related": verses})
+
+@app.route("/api/concordance/<translation>/<term>")
+@corpus_cached()
+def concordance_api(translation, term):
+    # ?books=Romans-Philemon adds a total over those books and limits the
+    # verse list to them; the list is paged with ?after=<verse_id>&limit=.
+    words = vocabulary.words(term)
+    if translation not in db.TRANSLATIONS or len(words) != 1:
+        abort(404)
+    conn = db.get_corpus_db()
+    if not concordance.has_index(conn):
+        abort(404)
+    entry = concordance.lookup(conn, translation, words[0])
+    if entry is None:
+        abort(404)
+    try:
+        books = concordance.book_ids(request.args["books"]) if request.args.get("books") else None
+    except ValueError:
+        abort(400)
+    after = request.args.get("after", 0, type=int)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), VERSES_MAX_PAGE_SIZE)
+    hits, next_after = concordance.occurrences(conn, translation, words[0], books, after, limit)
+    data = {
+        "translation": translation,
+        "term": words[0],
+        "occurrences": entry.occurrences,
+        "verses": entry.verses,
+        "books": entry.by_book(),
+        "testaments": entry.by_testament(),
+        "genres": entry.by_genre(),
+        "cooccurring": [{"term": w, "verses": n} for w, n in entry.related],
+        "hits": [{"id": db.format_verse_id(vid), "reference": references.format_reference(vid, vid),
+                  "text": str(text)} for vid, text in hits],
+        "next": db.format_verse_id(next_after) if next_after else None,
+    }
+    if books:
+        data["selected"] = {"books": [db.BOOK_NAMES[b] for b in books], "occurrences": entry.in_books(books)}
+    return jsonify(data)
+
+@app.route("/api/export/<translation>", defaults={"start": export.FIRST_VERSE, "end": export.LAST_VERSE})
+@app.route("/api/export/<translation>/<int:start>-<int:end>")
+def export_verses(translation, start, end):
+    # ?format=csv|json|ndjson; gzip when the client accepts it. The body is
+    # generated as it is sent; Range / If-Range resume a partial download.
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in export.FORMATS or translation not in db.TRANSLATIONS:
+        abort(404)
+    if end < start:
+        abort(400)
+    compress = bool(request.accept_encodings["gzip"])
+    build_hash, built_at = corpus_build()
+
+    response = Response(export.stream(fmt, translation, start, end, compress), mimetype=export.FORMATS[fmt])
+    response.headers["Content-Disposition"] = "attachment; filename=%s.%s" % (translation, fmt)
+    response.vary.add("Accept-Encoding")
+    if compress:
+        response.content_encoding = "gzip"
+    if not build_hash:
+        return response
+
+    etag = hashlib.sha1(("%s|%s|%s" % (build_hash, request.full_path, compress)).encode()).hexdigest()[:24]
+    response.set_etag(etag)
+    response.last_modified = built_at
+    response.cache_control.public = True
+    response.cache_control.max_age = CORPUS_MAX_AGE
+    if request.if_none_match.contains_weak(etag):
+        complete_length = None
+    elif "Range" in request.headers:
+        complete_length = export.length(build_hash, fmt, translation, start, end, compress)
+    else:
+        complete_length = export.known_length(build_hash, fmt, translation, start, end, compress)
+    if complete_length is not None and "Range" not in request.headers:
+        response.content_length = complete_length
+    return response.make_conditional(request, accept_ranges=True, complete_length=complete_length)
+
+def resolve_references(translation, refs):
+    # One pass over the mmap corpus, or a single indexed query without it.
+    mapped = corpus.open_corpus(translation)
+    if mapped is not None:
+        return [list(mapped.range(ref.start, ref.end, references.MAX_VERSES)) for ref in refs]
+    return references.resolve(db.get_corpus_db(), translation, refs)
+
+def parse_references(texts):
+    refs, errors = [], []
+    for text in texts:
+        try:
+            refs.extend(references.parse(text))
+        except ValueError as err:
+            errors.append(str(err))
+    return refs[:references.MAX_BATCH], errors
+
+@app.route("/api/passages/<translation>", methods=["GET", "POST"])
+@corpus_cached()
+def passages_api(translation):
+    # ?ref=Jn 3:16-18; Ps 23&ref=... or a JSON body {"refs": [...]}
+    if translation not in db.TRANSLATIONS:
+        abort(404)
+    texts = request.args.getlist("ref")
+    if request.method == "POST":
+        body = request.get_json(silent=True)
+        body = {} if body is None else body
+        if not isinstance(body, dict):
+            abort(400)
+        posted = body.get("refs", [])
+        if not isinstance(posted, list) or not all(isinstance(t, str) for t in posted):
+            abort(400)
+        texts += posted
+    refs, errors = parse_references(texts)
+    results = resolve_references(translation, refs)
+    return jsonify({
+        "translation": translation,
+        "passages": [{
+            "ref": ref.text,
+            "reference": references.format_reference(ref.start, ref.end),
+            "start": db.format_verse_id(ref.start),
+            "end": db.format_verse_id(ref.end),
+            "verses": [{"id": db.format_verse_id(vid), "chapter": ch, "verse": v, "text": text}
+                       for vid, _, ch, v, text in rows],
+        } for ref, rows in zip(refs, results)],
+        "errors": errors,
+    })
+
+@app.route("/passage/<translation>")
+@corpus_cached()
+def passage(translation):
+    refs, errors = parse_references(request.args.getlist("ref"))
+    results = resolve_references(translation, refs)
+    passages = [(references.format_reference(ref.start, ref.end), rows) for ref, rows in zip(refs, results)]
+    return render_template("passage.html", translation=translation, passages=passages, errors=errors)
+
+def parallel_passages(refs, translations):
+    # Aligns each passage by verse id: [(reference, [(verse_id, chapter, verse, {translation: text})])]
+    passages = []
+    limit = references.MAX_VERSES * len(translations)
+    for ref in refs:
+        mapped = [corpus.open_corpus(t) for t in translations]
+        if all(m is not None for m in mapped):
+            rows = [(vid, t, book, ch, v, text)
+                    for t, m in zip(translations, mapped)
+                    for vid, book, ch, v, text in m.range(ref.start, ref.end, references.MAX_VERSES)]
+            rows.sort(key=lambda row: row[0])
+        else:
+            rows = db.read_parallel(db.get_corpus_db(), translations, ref.start, ref.end, limit)
+        aligned = {}
+        for vid, t, _, ch, v, text in rows:
+            aligned.setdefault(vid, (vid, ch, v, {}))[3][t] = text
+        passages.append((references.format_reference(ref.start, ref.end), list(aligned.values())))
+    return passages
+
+def requested_translations():
+    # ?t=KJV,WEB or ?t=KJV&t=WEB; defaults to every translation
+    names = [t.strip().upper() for value in request.args.getlist("t") for t in value.split(",")]
+    chosen = [t for t in db.TRANSLATIONS if t in names]
+    return chosen or list(db.TRANSLATIONS)
+
+@app.route("/parallel")
+@corpus_cached()
+def parallel():
+    translations = requested_translations()
+    refs, errors = parse_references(request.args.getlist("ref"))
+    return render_template("parallel.html", translations=translations, all_translations=db.TRANSLATIONS,
+                           ref="; ".join(request.args.getlist("ref")),
+                           passages=parallel_passages(refs, translations), errors=errors)
+
+@app.route("/api/parallel")
+@corpus_cached()
+def parallel_api():
+    translations = requested_translations()
+    refs, errors = parse_references(request.args.getlist("ref"))
+    return jsonify({
+        "translations": translations,
+        "passages": [{
+            "reference": reference,
+            "verses": [{"id": db.format_verse_id(vid), "chapter": ch, "verse": v, "text": texts}
+                       for vid, ch, v, texts in rows],
+        } for reference, rows in parallel_passages(refs, translations)],
+        "errors": errors,
+    })
+
+@app.route("/api/autocomplete")
+@corpus_cached()
+def autocomplete_api():
+    # ?q=<partial text>&t=<translation>&limit=; each suggestion carries the
+    # page it leads to.
+    translation = request.args.get("t")
+    if translation and translation not in db.TRANSLATIONS:
+        abort(404)
+    limit = min(max(request.args.get("limit", autocomplete.TOP_K, type=int), 1), autocomplete.MAX_LIMIT)
+    target = translation or "KJV"
+    suggestions = autocomplete.suggest(request.args.get("q", ""), translation, limit)
+    for s in suggestions:
+        if s["kind"] == "reference":
+            s["url"] = url_for("passage", translation=target, ref=s["text"])
+        elif s["kind"] == "book":
+            s["url"] = url_for("chapter", translation=target, book=s["book"], chapter=1)
+        else:
+            s["url"] = url_for("search", translation=translation, keyword=s["text"])
+    return jsonify({"query": request.args.get("q", ""), "suggestions": suggestions})
+
+@app.route("/search", defaults={"translation": None}, methods=["GET", "POST"])
+@app.route("/search/<translation>", methods=["GET", "POST"])
+def search(translation):
+    keyword = request.values.get("keyword", "").strip()
+    book = db.book_id(request.values.get("book", "")) if request.values.get("book") else None
+    page = max(request.values.get("page", 1, type=int), 1)
+    email = request.values.get("email", "").strip()
+    # mode: "keyword" (ranked full-text), "phrase" or "near" (positional index)
+    mode = request.values.get("mode", "keyword")
+    distance = request.values.get("distance", positions.DEFAULT_DISTANCE, type=int)
+    # Words missing from the corpus are always matched fuzzily; ?fuzzy=1 widens every word.
+    fuzzy_all = bool(request.values.get("fuzzy"))
+
+    results, has_next, credits, expansions = [], False, None, {}
+    corpus_db = db.get_corpus_db()
+    if keyword and mode in positions.MODES and positions.has_index(corpus_db):
+        results, has_next = positions.search(corpus_db, keyword, mode, distance, translation, book, page)
+    elif keyword and verse_search.has_index(corpus_db):
+        expansions = fuzzy.expand(corpus_db, keyword, fuzzy_all)
+        results, has_next = verse_search.search(corpus_db, keyword, translation, book, page,
+                                                expansions=expansions)
+    if email:
+        row = db.get_db().execute("SELECT credits FROM users WHERE email = ?", (email,)).fetchone()
+        credits = row[0] if row else None
+
+    items = [Markup('<a href="{}#v{}">{} {}:{}</a> ({}) - {}').format(
+                 url_for("chapter", translation=r["translation"], book=db.unpack_verse_id(r["verse_id"])[0],
+                         chapter=r["chapter"]),
+                 r["verse"], r["book"], r["chapter"], r["verse"], r["translation"], r["snippet"])
+             for r in results]
+    def page_url(p):
+        return url_for("search", translation=translation, keyword=keyword, book=book or "", mode=mode,
+                       distance=distance, fuzzy=1 if fuzzy_all else "", page=p)
+
+    return render_template("search.html", translation=translation or "All translations",
+                           keyword=keyword, book=book, results=items, credits=credits, books=db.BOOKS,
+                           mode=mode, distance=distance, fuzzy=fuzzy_all, expansions=expansions,
+                           prev_url=page_url(page - 1) if page > 1 else None,
+                           next_url=page_url(page + 1) if has_next else None)
+
+@app.route("/search_book/<translation>", methods=["GET", "POST"])
+def search_book(translation):
+    bookname = request.values.get("bookname", "").strip()
+    results = []
+    b = db.book_id(bookname) if bookname else None
+    if b is not None:
+        rows = read_range(translation, db.pack_verse_id(b, 0, 0), db.pack_verse_id(b, 999, 999))
+        results = [Markup("{} {}:{} - {}").format(book, ch, v, text) for _, book, ch, v, text in rows]
+    return render_template("search_book.html", translation=translation, results=results)
+
+# ---------------------------
+# Offline reading
+# ---------------------------
+
+@app.route("/service-worker.js")
+def service_worker():
+    # Served from the root so the worker's scope covers the whole site.
+    response = send_from_directory(app.static_folder, "service-worker.js", mimetype="text/javascript")
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route("/offline")
+def offline():
+    return render_template("offline.html")
+
+@app.route("/offline/manifest.json")
+def offline_manifest():
+    loaded = bundles.load_manifest()
+    if loaded is None:
+        abort(404)
+    response = Response(loaded[1], mimetype="application/json")
+    response.set_etag(hashlib.sha1(loaded[1]).hexdigest()[:24])
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+@app.route("/offline/bundles/<translation>/<name>")
+def offline_bundle(translation, name):
+    # File names carry the content hash, so a bundle URL never changes.
+    path = bundles.bundle_path(translation, name)
+    if path is None:
+        abort(404)
+    if not request.accept_encodings["gzip"]:
+        with open(path, "rb") as f:
+            return Response(gzip.decompress(f.read()), mimetype="application/json")
+    response = send_file(path, mimetype="application/json", max_age=IMMUTABLE_MAX_AGE)
+    response.content_encoding = "gzip"
+    response.vary.add("Accept-Encoding")
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+    return response
+
+@app.route("/cache/stats")
+def cache_stats():
+    return jsonify(page_cache.stats())
 
 @app.route("/favorites")
 def favorites():
@@ -112,6 +570,5 @@ def help():
 # Run App
 # ---------------------------
 if __name__ == "__main__":
-    if not os.path.exists("app.db"):
-        init_db()
+    init_db()
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,152 @@
+"""
+Typeahead suggestions for book names and abbreviations, references and
+corpus vocabulary.
+
+Each source is a PrefixIndex: sorted keys with parallel weights, so the
+entries starting with a prefix are one bisect away. The top suggestions for
+every prefix of up to SHORT_PREFIX characters, where those ranges run to
+thousands of words, are worked out when the index is built, and longer
+prefixes rank their (short) range on the fly. Indexes are built once per
+process and corpus build.
+"""
+import heapq
+import re
+from array import array
+from bisect import bisect_left
+
+import corpus
+import db
+import references
+import vocabulary
+from http_cache import corpus_build
+
+SHORT_PREFIX = 3
+TOP_K = 10
+MAX_LIMIT = 25
+
+_BOOK_AND_REST = re.compile(r"^\s*(?P<book>.*?[a-z.])\s*(?P<rest>\d[\d:,\-\s]*)$", re.I)
+
+class PrefixIndex(object):
+
+    def __init__(self, entries, top_k=TOP_K):
+        """entries: (key, value, weight) triples; keys need not be unique."""
+        entries = sorted(entries)
+        self.keys = [key for key, _, _ in entries]
+        self.values = [value for _, value, _ in entries]
+        self.weights = array("q", (weight for _, _, weight in entries))
+        self.top_k = top_k
+        prefixes = {key[:n] for key in self.keys for n in range(1, SHORT_PREFIX + 1)}
+        self.top = {prefix: self._rank(prefix, top_k) for prefix in prefixes}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _rank(self, prefix, limit):
+        lo = bisect_left(self.keys, prefix)
+        hi = bisect_left(self.keys, prefix + "\uffff", lo)
+        if hi - lo <= limit:
+            best = sorted(range(lo, hi), key=self.weights.__getitem__, reverse=True)
+        else:
+            best = heapq.nlargest(limit, range(lo, hi), key=self.weights.__getitem__)
+        return [(self.keys[i], self.values[i], self.weights[i]) for i in best]
+
+    def complete(self, prefix, limit=TOP_K):
+        """Up to limit (key, value, weight) entries starting with prefix,
+        heaviest first."""
+        if not prefix:
+            return []
+        if len(prefix) <= SHORT_PREFIX and limit <= self.top_k:
+            return self.top.get(prefix, [])[:limit]
+        return self._rank(prefix, limit)
+
+# ---------------------------
+# Indexes
+# ---------------------------
+
+def _book_index():
+    # Names, abbreviations and unique name prefixes from references.BOOK_TABLE;
+    # earlier books rank first.
+    return PrefixIndex((key, book_id, -book_id) for key, book_id in references.BOOK_TABLE.items())
+
+_indexes = {}
+
+def book_index():
+    if "books" not in _indexes:
+        _indexes["books"] = _book_index()
+    return _indexes["books"]
+
+def word_index(translation=None):
+    """Vocabulary of one translation (or all), weighted by occurrences."""
+    build_hash, _ = corpus_build()
+    key = ("words", build_hash, translation)
+    if key not in _indexes:
+        conn = db.get_corpus_db()
+        counts = vocabulary.term_counts(conn, translation) if vocabulary.has_vocabulary(conn) else {}
+        for stale in [k for k in _indexes if k[0] == "words" and k[1] != build_hash]:
+            del _indexes[stale]
+        _indexes[key] = PrefixIndex((term, term, n) for term, n in counts.items())
+    return _indexes[key]
+
+# ---------------------------
+# Suggestions
+# ---------------------------
+
+def _books(query, limit):
+    seen = []
+    if limit <= 0:
+        return seen
+    for _, book_id, _ in book_index().complete(references.normalize_book(query), len(book_index())):
+        if book_id not in seen:
+            seen.append(book_id)
+            if len(seen) == limit:
+                break
+    return seen
+
+def _exists(translation, ref):
+    mapped = corpus.open_corpus(translation)
+    if mapped is not None:
+        return next(mapped.range(ref.start, ref.end, 1), None) is not None
+    return db.read_range(db.get_corpus_db(), translation, ref.start, ref.end, 1).fetchone() is not None
+
+def _references(query, translation, limit):
+    # "jn 3:16" parses as is; "jo 3" is ambiguous, so the book part is
+    # completed and each candidate book tried in turn.
+    query = query.rstrip(" :,-")
+    m = _BOOK_AND_REST.match(query)
+    if not m:
+        return []
+    candidates = [query]
+    candidates += ["%s %s" % (db.BOOK_NAMES[b], m.group("rest")) for b in _books(m.group("book"), limit)]
+    found = []
+    for text in candidates:
+        try:
+            refs = references.parse(text)
+        except ValueError:
+            continue
+        if len(refs) != 1 or not _exists(translation, refs[0]):
+            continue
+        label = references.format_reference(refs[0].start, refs[0].end)
+        if label not in found:
+            found.append(label)
+            if len(found) == limit:
+                break
+    return found
+
+def suggest(query, translation=None, limit=TOP_K):
+    """Suggestions as dicts with "text" and "kind" ("reference", "book" or
+    "word"), plus "book" for books and "count" for words."""
+    query = query.strip()
+    if not query:
+        return []
+    suggestions = [{"text": text, "kind": "reference"}
+                   for text in _references(query, translation or "KJV", limit)]
+    if not _BOOK_AND_REST.match(query.rstrip(" :,-")):
+        suggestions += [{"text": db.BOOK_NAMES[b], "kind": "book", "book": b}
+                        for b in _books(query, limit - len(suggestions))]
+        # Complete the last word; earlier words are kept as typed.
+        last = vocabulary.words(query)
+        if last and len(suggestions) < limit and query[-1].isalpha() and not any(c.isdigit() for c in query):
+            head = query[:len(query) - len(last[-1])] if query.lower().endswith(last[-1]) else ""
+            suggestions += [{"text": head + term, "kind": "word", "count": n}
+                            for term, _, n in word_index(translation).complete(last[-1], limit - len(suggestions))]
+    return suggestions[:limit]
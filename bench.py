@@ -0,0 +1,260 @@
+"""
+Route benchmarks with latency percentiles.
+
+    python bench.py                                   # Flask test client
+    python bench.py --server gunicorn --workers 4     # real gunicorn over HTTP
+    python bench.py --save-baseline bench_baseline.json
+    python bench.py --compare bench_baseline.json     # exit 1 on regressions
+
+A scratch directory is seeded with all five translations by ingest.py (the
+corpus database, FTS index and mmap files) and an empty app.db, and each
+route is driven for --requests requests after --warmup unmeasured ones.
+Reports p50/p95/p99 latency, throughput and peak RSS per route; with the
+test client each route runs in its own interpreter so its peak RSS is its own.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ROUTES = (
+    "/verses/KJV",
+    "/verses/KJV?after=40000000",
+    "/verses/KJV?stream=1",
+    "/verses/KJV/19/119",
+    "/verse/KJV",
+    "/api/verse/KJV/43003016",
+    "/api/verses/KJV/01001001-02001005",
+    "/api/passages/KJV?ref=Jn 3:16-18; Ps 23; 1 Cor 13:4-7",
+    "/api/parallel?ref=Rom 8&t=KJV,WEB,ASV,BBE,YLT",
+    "/search?keyword=love",
+    "/search/KJV?keyword=grace faith",
+)
+
+def seed(workdir):
+    """Point the app at workdir and load the corpus into it."""
+    os.environ["DATABASE"] = os.path.join(workdir, "app.db")
+    os.environ["CORPUS_DATABASE"] = os.path.join(workdir, "corpus.db")
+    os.environ["CORPUS_DIR"] = os.path.join(workdir, "corpus")
+    sys.path.insert(0, BASE_DIR)
+    import sqlite3
+
+    import db
+    import ingest
+
+    conn = sqlite3.connect(db.DATABASE)
+    db.init_db(conn)
+    conn.close()
+    ingest.ingest(db.CORPUS_DATABASE, corpus_dir=os.environ["CORPUS_DIR"])
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def summarize(route, latencies, wall, rss_kb):
+    latencies.sort()
+    return {
+        "route": route,
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "rps": round(len(latencies) / wall, 1) if wall else 0.0,
+        "peak_rss_mb": round(rss_kb / 1024.0, 1) if rss_kb else None,
+    }
+
+# ---------------------------
+# Drivers
+# ---------------------------
+
+def run_test_client(routes, requests, warmup):
+    """Each route in a fresh python running bench.py --child against the
+    already seeded directory (passed on in the environment)."""
+    results = []
+    for route in routes:
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--route", route,
+             "--requests", str(requests), "--warmup", str(warmup)],
+            cwd=BASE_DIR, env=os.environ.copy(), stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        results.append(json.loads(child.stdout.splitlines()[-1]))
+    return results
+
+def _run_in_process(routes, requests, warmup):
+    import app as bible_app
+
+    client = bible_app.app.test_client()
+    results = []
+    for route in routes:
+        for _ in range(warmup):
+            client.get(route).close()
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(requests):
+            t0 = time.perf_counter()
+            response = client.get(route)
+            response.get_data()
+            latencies.append(time.perf_counter() - t0)
+            if response.status_code != 200:
+                raise RuntimeError("%s returned %d" % (route, response.status_code))
+        wall = time.perf_counter() - started
+        results.append(summarize(route, latencies, wall, _peak_rss_kb()))
+    return results
+
+def _peak_rss_kb():
+    # VmHWM starts again at exec, where ru_maxrss keeps the forking parent's
+    # peak (here the ingest in seed); ru_maxrss where there is no /proc.
+    try:
+        for line in open("/proc/self/status"):
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _worker_peak_rss_kb(master_pid):
+    # VmHWM of every gunicorn worker (Linux /proc); None elsewhere.
+    try:
+        children = open("/proc/%d/task/%d/children" % (master_pid, master_pid)).read().split()
+        peaks = []
+        for pid in children:
+            for line in open("/proc/%s/status" % pid):
+                if line.startswith("VmHWM:"):
+                    peaks.append(int(line.split()[1]))
+        return max(peaks) if peaks else None
+    except OSError:
+        return None
+
+def run_gunicorn(routes, requests, warmup, workers, concurrency):
+    port = _free_port()
+    server = subprocess.Popen(
+        ["gunicorn", "app:app", "-w", str(workers), "-b", "127.0.0.1:%d" % port, "--log-level", "warning"],
+        cwd=BASE_DIR, env=os.environ.copy())
+    base = "http://127.0.0.1:%d" % port
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(base + "/home").read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("gunicorn did not start on port %d" % port)
+
+        def fetch(route):
+            url = base + urllib.request.quote(route, safe="/?=&,:;")
+            t0 = time.perf_counter()
+            with urllib.request.urlopen(url) as response:
+                response.read()
+            return time.perf_counter() - t0
+
+        results = []
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for route in routes:
+                list(pool.map(fetch, [route] * warmup))
+                started = time.perf_counter()
+                latencies = list(pool.map(fetch, [route] * requests))
+                wall = time.perf_counter() - started
+                results.append(summarize(route, latencies, wall, _worker_peak_rss_kb(server.pid)))
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+# ---------------------------
+# Reporting
+# ---------------------------
+
+def print_table(results):
+    print("%-55s %9s %9s %9s %9s %9s" % ("route", "p50 ms", "p95 ms", "p99 ms", "req/s", "rss MB"))
+    for r in results:
+        print("%-55s %9.3f %9.3f %9.3f %9.1f %9s" % (
+            r["route"][:55], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["rps"], r["peak_rss_mb"]))
+
+def compare(results, baseline, tolerance):
+    """Routes whose p50 or p95 grew by more than tolerance (a fraction)."""
+    previous = {r["route"]: r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        before = previous.get(r["route"])
+        if not before:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            if before[metric] and r[metric] > before[metric] * (1 + tolerance):
+                regressions.append("%s %s %.3f -> %.3f ms (+%.0f%%)" % (
+                    r["route"], metric, before[metric], r[metric], 100.0 * (r[metric] / before[metric] - 1)))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Flask routes.")
+    parser.add_argument("--server", choices=("client", "gunicorn"), default="client")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per route")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests per route")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads against gunicorn")
+    parser.add_argument("--route", action="append", help="route to run (repeatable; default: all)")
+    parser.add_argument("--no-render-cache", action="store_true", help="measure with the page cache off")
+    parser.add_argument("--workdir", help="reuse a seeded directory instead of a temporary one")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown vs baseline")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # One route of run_test_client: the caller has seeded and set the environment.
+        sys.path.insert(0, BASE_DIR)
+        for result in _run_in_process(args.route, args.requests, args.warmup):
+            print(json.dumps(result))
+        return
+
+    if args.no_render_cache:
+        os.environ["RENDER_CACHE_MAX_BYTES"] = "0"
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bible-bench-")
+    try:
+        os.makedirs(workdir, exist_ok=True)
+        seed(workdir)
+        routes = args.route or ROUTES
+        if args.server == "gunicorn":
+            results = run_gunicorn(routes, args.requests, args.warmup, args.workers, args.concurrency)
+        else:
+            results = run_test_client(routes, args.requests, args.warmup)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(results)
+    report = {"server": args.server, "requests": args.requests, "created": int(time.time()), "results": results}
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Baseline saved to %s" % args.save_baseline)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            sys.exit(1)
+        print("No regressions beyond %.0f%%." % (args.tolerance * 100))
+
+if __name__ == "__main__":
+    main()
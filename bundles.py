@@ -0,0 +1,121 @@
+"""
+Offline reading bundles: one gzip-compressed JSON file per translation and
+book, named by the hash of its content, plus a manifest listing them.
+
+    python bundles.py                # rebuild corpus/bundles from the verses table
+
+    manifest.json                    {"build": ..., "bundles": {"KJV": {"1": {...}}}}
+    KJV/1.<hash>.json.gz             {"translation", "book", "name", "chapters"}
+
+"chapters" holds [verse, text] pairs per chapter, chapter 1 first. A book
+whose text did not change keeps its file name across builds, so the service
+worker compares the manifest against what it has cached and only downloads
+the bundles that changed.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+from itertools import groupby
+
+import corpus
+import db
+
+BUNDLE_DIR = os.environ.get("BUNDLE_DIR", os.path.join(corpus.CORPUS_DIR, "bundles"))
+MANIFEST = "manifest.json"
+
+def bundle_name(book_id, digest):
+    return "%d.%s.json.gz" % (book_id, digest)
+
+def _book_bundle(translation, book_id, rows):
+    chapters = []
+    for chapter, verses in groupby(rows, key=lambda row: db.unpack_verse_id(row[0])[1]):
+        while len(chapters) < chapter:
+            chapters.append([])
+        chapters[chapter - 1] = [[db.unpack_verse_id(verse_id)[2], text] for verse_id, text in verses]
+    return {"translation": translation, "book": book_id,
+            "name": db.BOOK_NAMES.get(book_id, ""), "chapters": chapters}
+
+def build(conn, translation, out_dir):
+    """Write the bundles of one translation; returns its manifest entries."""
+    os.makedirs(out_dir, exist_ok=True)
+    entries = {}
+    cur = conn.execute("SELECT verse_id, text FROM verses WHERE translation = ? ORDER BY verse_id", (translation,))
+    for book_id, rows in groupby(cur, key=lambda row: db.unpack_verse_id(row[0])[0]):
+        data = json.dumps(_book_bundle(translation, book_id, rows), ensure_ascii=False,
+                          separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha1(data).hexdigest()[:16]
+        name = bundle_name(book_id, digest)
+        path = os.path.join(out_dir, name)
+        if not os.path.exists(path):
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(gzip.compress(data, mtime=0))
+            os.replace(tmp, path)
+        entries[str(book_id)] = {"name": db.BOOK_NAMES.get(book_id, ""), "hash": digest,
+                                 "file": name, "size": os.path.getsize(path)}
+    return entries
+
+def build_all(conn, bundle_dir=BUNDLE_DIR):
+    """Rebuild every translation's bundles and the manifest, then remove
+    bundle files the new manifest no longer lists."""
+    row = conn.execute("SELECT value FROM corpus_meta WHERE key = 'build_hash'").fetchone()
+    manifest = {"build": row[0] if row else "", "bundles": {}}
+    for (translation,) in conn.execute("SELECT DISTINCT translation FROM verses ORDER BY translation").fetchall():
+        manifest["bundles"][translation] = build(conn, translation, os.path.join(bundle_dir, translation))
+
+    path = os.path.join(bundle_dir, MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+    for translation, entries in manifest["bundles"].items():
+        keep = {entry["file"] for entry in entries.values()}
+        folder = os.path.join(bundle_dir, translation)
+        for name in os.listdir(folder):
+            if name not in keep:
+                os.remove(os.path.join(folder, name))
+    return manifest
+
+_manifest = {}
+
+def load_manifest(bundle_dir=BUNDLE_DIR):
+    """The manifest as (mtime, raw JSON bytes, parsed dict), reloaded when the
+    file changes; None before bundles have been built."""
+    path = os.path.join(bundle_dir, MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _manifest.get(bundle_dir)
+    if cached is None or cached[0] != mtime:
+        with open(path, "rb") as f:
+            raw = f.read()
+        cached = _manifest[bundle_dir] = (mtime, raw, json.loads(raw))
+    return cached
+
+def bundle_path(translation, name, bundle_dir=BUNDLE_DIR):
+    """Path of a listed bundle file, or None for anything else."""
+    loaded = load_manifest(bundle_dir)
+    if loaded is None:
+        return None
+    for entry in loaded[2]["bundles"].get(translation, {}).values():
+        if entry["file"] == name:
+            return os.path.join(bundle_dir, translation, name)
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Build offline reading bundles from the verses table.")
+    parser.add_argument("--db", default=db.CORPUS_DATABASE, help="corpus database file (default: %(default)s)")
+    parser.add_argument("--out", default=BUNDLE_DIR, help="output folder (default: %(default)s)")
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db)
+    manifest = build_all(conn, args.out)
+    for translation, entries in sorted(manifest["bundles"].items()):
+        print("%s: %d books, %d bytes" % (translation, len(entries), sum(e["size"] for e in entries.values())))
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import sqlite3
 
-conn = sqlite3.connect("app.db")
+import db
+
+conn = sqlite3.connect(db.DATABASE)
 cur = conn.cursor()
 
 # List all tables
@@ -12,8 +14,17 @@ print("Tables:", tables)
 cur.execute("PRAGMA table_info(users);")
 print("Users table columns:", cur.fetchall())
 
+conn.close()
+
+conn = sqlite3.connect(db.CORPUS_DATABASE)
+cur = conn.cursor()
+
 # Show columns in verses table
 cur.execute("PRAGMA table_info(verses);")
 print("Verses table columns:", cur.fetchall())
 
+# Show indexes on verses table
+cur.execute("PRAGMA index_list(verses);")
+print("Verses table indexes:", cur.fetchall())
+
 conn.close()
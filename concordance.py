@@ -0,0 +1,213 @@
+"""
+Concordance: how often a word occurs in each book, testament and genre,
+the words it most often shares a verse with, and every verse it occurs in.
+
+Counts are worked out at ingest into the concordance table of corpus.db, one
+row per (translation, term):
+
+    books       uint32 occurrences per book id (index 0 unused)
+    related     JSON [[word, shared verses], ...], strongest first
+
+so a request reads one row and sums at most 66 numbers; testament, genre
+and book-range totals ("Romans-Philemon") come from db.BOOKS. Occurrence
+lists are read from the positional index (positions.py).
+"""
+import gc
+import heapq
+import json
+import math
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from itertools import chain
+
+import db
+import positions
+import references
+import vocabulary
+from http_cache import corpus_build
+
+MAX_BOOK = max(book_id for book_id, _, _, _ in db.BOOKS)
+MAX_RELATED = 10
+MIN_SHARED = 2
+CACHE_SIZE = 1024
+
+# Function words (and their King James forms) left out of co-occurrence.
+STOPWORDS = frozenset("""
+a about after against all also am an and any are as at be because been before being but by came can come
+did do does doth done for from had has hast hath have he her him his how i if in into is it its let may
+me mine my no nor not now o of on one or our out over said saith say shall shalt she should so than that
+the thee their them then there these they thine this those thou thus thy to unto up upon us was we were
+what when which who whom why will wilt with would ye yea you your
+""".split())
+
+# ---------------------------
+# Build
+# ---------------------------
+
+def count_translation(rows):
+    """Concordance rows of one translation from (verse_id, text) rows:
+    [(term, verses, books bytes, related json)]. Runs in the ingest pool."""
+    gc.disable()
+    try:
+        return _count_translation(rows)
+    finally:
+        gc.enable()
+
+def _count_translation(rows):
+    by_book = {}
+    verses = Counter()
+    content, containing = [], {}
+    for verse_id, text in rows:
+        found = vocabulary.words(text)
+        by_book.setdefault(verse_id // 1000000, Counter()).update(found)
+        unique = set(found)
+        verses.update(unique)
+        unique -= STOPWORDS
+        for term in unique:
+            containing.setdefault(term, []).append(len(content))
+        content.append(unique)
+
+    books = {}
+    for book, counts in by_book.items():
+        for term, n in counts.items():
+            if term not in books:
+                books[term] = array("I", bytes(4 * (MAX_BOOK + 1)))
+            books[term][book] = n
+
+    # Shared verses weighted by the other word's idf, so "grace" pairs with
+    # "peace" ahead of "lord".
+    idf = {term: math.log(len(content) / n) for term, n in verses.items()}
+    out = []
+    for term, counts in books.items():
+        best = []
+        if verses[term] >= MIN_SHARED and term in containing:
+            shared = Counter(chain.from_iterable(content[i] for i in containing[term]))
+            del shared[term]
+            best = heapq.nlargest(MAX_RELATED, [(n * idf[w], w, n) for w, n in shared.items() if n >= MIN_SHARED])
+        out.append((term, verses[term], counts.tobytes(), json.dumps([[w, n] for _, w, n in best])))
+    return out
+
+def build(conn, map=map, translations=None):
+    """Rebuild the concordance table, one translation per call of map; with
+    translations, only their rows unless the table is new."""
+    if not has_index(conn):
+        translations = None
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS concordance (
+        translation TEXT NOT NULL,
+        term TEXT NOT NULL,
+        verses INTEGER NOT NULL,
+        books BLOB NOT NULL,
+        related TEXT NOT NULL,
+        PRIMARY KEY (translation, term)
+    ) WITHOUT ROWID
+    """)
+    where, params = db.translation_filter(translations)
+    conn.execute("DELETE FROM concordance" + where, params)
+    rows = {}
+    for translation, verse_id, text in conn.execute(
+            "SELECT translation, verse_id, text FROM verses%s ORDER BY translation, verse_id" % where, params):
+        rows.setdefault(translation, []).append((verse_id, text))
+    for translation, entries in zip(rows, map(count_translation, rows.values())):
+        conn.executemany("INSERT INTO concordance (translation, term, verses, books, related) VALUES (?, ?, ?, ?, ?)",
+                         ((translation,) + row for row in entries))
+
+def has_index(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'concordance'").fetchone() is not None
+
+# ---------------------------
+# Lookup
+# ---------------------------
+
+class Entry(object):
+    """Decoded concordance row."""
+
+    def __init__(self, verses, books, related):
+        self.verses = verses
+        self.books = array("I")
+        self.books.frombytes(books)
+        self.related = json.loads(related)
+
+    @property
+    def occurrences(self):
+        return sum(self.books)
+
+    def by_book(self):
+        return {db.BOOK_NAMES[b]: n for b, n in enumerate(self.books) if n and b in db.BOOK_NAMES}
+
+    def by_testament(self):
+        totals = {}
+        for book_id, _, testament, _ in db.BOOKS:
+            totals[testament] = totals.get(testament, 0) + self.books[book_id]
+        return totals
+
+    def by_genre(self):
+        totals = dict.fromkeys(db.GENRES.values(), 0)
+        for book_id, _, _, genre in db.BOOKS:
+            totals[db.GENRES[genre]] += self.books[book_id]
+        return totals
+
+    def in_books(self, book_ids):
+        return sum(self.books[b] for b in book_ids)
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+def lookup(conn, translation, term):
+    """Entry for term in translation, or None if it never occurs; recently
+    used entries of the current build stay decoded."""
+    key = (corpus_build()[0], translation, term)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    row = conn.execute("SELECT verses, books, related FROM concordance WHERE translation = ? AND term = ?",
+                       (translation, term)).fetchone()
+    entry = Entry(*row) if row else None
+    with _lock:
+        _cache[key] = entry
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return entry
+
+def book_ids(spec):
+    """Book ids named by a comma-separated list of books and book ranges,
+    e.g. "Romans-Philemon", "45-58", "Mt,Mk,Lk,Jn". ValueError if a book is
+    not recognised or a range runs backwards."""
+    found = []
+    for part in spec.split(","):
+        ends = [_book(name) for name in part.split("-")]
+        if len(ends) > 2:
+            raise ValueError("Bad book range: %s" % part)
+        if ends[0] > ends[-1]:
+            raise ValueError("Book range runs backwards: %s" % part)
+        found.extend(range(ends[0], ends[-1] + 1))
+    return list(dict.fromkeys(found))
+
+def _book(name):
+    book = db.book_id(name.strip()) or references.lookup_book(name)
+    if book is None:
+        raise ValueError("Unknown book: %s" % name.strip())
+    return book
+
+# ---------------------------
+# Occurrences
+# ---------------------------
+
+def occurrences(conn, translation, term, book_ids=None, after=0, limit=50):
+    """([(verse_id, highlighted text)], next after) for the verses holding
+    term, in verse order from after (exclusive)."""
+    postings = positions.load(conn, translation, term) if positions.has_index(conn) else None
+    if postings is None:
+        return [], None
+    wanted = set(book_ids) if book_ids else None
+    hits = []
+    for verse_id, found in postings.iter_from(after + 1):
+        if verse_id <= after or (wanted and verse_id // 1000000 not in wanted):
+            continue
+        if len(hits) == limit:
+            return hits, hits[-1][0]
+        hits.append((verse_id, positions.highlight(positions.verse_text(conn, translation, verse_id), set(found))))
+    return hits, None
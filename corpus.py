@@ -0,0 +1,180 @@
+"""
+Memory-mapped corpus files, one per translation, built from the verses table.
+
+    python corpus.py                 # rebuild corpus/<translation>.corpus files
+
+Layout (little-endian, every section 4-byte aligned):
+
+    header    magic, verse count, text size, build hash
+    chapters  (start, count) uint32 pairs for every book 0-66 x chapter 0-150
+    ids       uint32 verse id of every verse, ascending
+    offsets   uint32 start of every verse in the text blob, plus the end
+    text      UTF-8 verse text, back to back
+
+Workers open the files lazily with mmap, so they share the same page-cache
+pages and nothing is copied onto each worker's heap. A verse or chapter is a
+slice at a position taken from the chapter table.
+"""
+import argparse
+import mmap
+import os
+import sqlite3
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+import db
+
+CORPUS_DIR = os.environ.get("CORPUS_DIR", "corpus")
+MAGIC = b"BIBLCRP1"
+HEADER = struct.Struct("<8sII16s")
+MAX_BOOK = 66
+MAX_CHAPTER = 150
+CHAPTER_SLOTS = (MAX_BOOK + 1) * (MAX_CHAPTER + 1)
+
+def corpus_path(translation, corpus_dir=CORPUS_DIR):
+    return os.path.join(corpus_dir, "%s.corpus" % translation)
+
+# ---------------------------
+# Build
+# ---------------------------
+
+def build(conn, translation, path, build_hash=""):
+    """Write the corpus file for one translation; returns the verse count."""
+    ids, offsets, text = array("I"), array("I"), bytearray()
+    chapters = array("I", bytes(8 * CHAPTER_SLOTS))
+    for verse_id, verse_text in conn.execute(
+            "SELECT verse_id, text FROM verses WHERE translation = ? ORDER BY verse_id", (translation,)):
+        b, c, _ = db.unpack_verse_id(verse_id)
+        slot = 2 * (b * (MAX_CHAPTER + 1) + c)
+        if not chapters[slot + 1]:
+            chapters[slot] = len(ids)
+        chapters[slot + 1] += 1
+        ids.append(verse_id)
+        offsets.append(len(text))
+        text += verse_text.encode("utf-8")
+    offsets.append(len(text))
+    if not ids:
+        return 0
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(ids), len(text), build_hash.encode("ascii")[:16]))
+        chapters.tofile(f)
+        ids.tofile(f)
+        offsets.tofile(f)
+        f.write(text)
+    # Replace atomically: workers still mapping the old file keep its inode.
+    os.replace(tmp, path)
+    return len(ids)
+
+def build_all(conn, corpus_dir=CORPUS_DIR):
+    os.makedirs(corpus_dir, exist_ok=True)
+    row = conn.execute("SELECT value FROM corpus_meta WHERE key = 'build_hash'").fetchone()
+    build_hash = row[0] if row else ""
+    counts = {}
+    for (translation,) in conn.execute("SELECT DISTINCT translation FROM verses").fetchall():
+        counts[translation] = build(conn, translation, corpus_path(translation, corpus_dir), build_hash)
+    return counts
+
+# ---------------------------
+# Read
+# ---------------------------
+
+class Corpus(object):
+    """Read-only view of one translation's corpus file."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, text_size, build_hash = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a corpus file" % path)
+        self.count = count
+        self.build_hash = build_hash.rstrip(b"\0").decode("ascii")
+
+        view = memoryview(self.mm)
+        pos = HEADER.size
+        self.chapters = view[pos:pos + 8 * CHAPTER_SLOTS].cast("I")
+        pos += 8 * CHAPTER_SLOTS
+        self.ids = view[pos:pos + 4 * count].cast("I")
+        pos += 4 * count
+        self.offsets = view[pos:pos + 4 * (count + 1)].cast("I")
+        pos += 4 * (count + 1)
+        self.text_start = pos
+
+    def _text(self, i):
+        return self.mm[self.text_start + self.offsets[i]:self.text_start + self.offsets[i + 1]].decode("utf-8")
+
+    def _rows(self, lo, hi):
+        for i in range(lo, hi):
+            verse_id = self.ids[i]
+            b, c, v = db.unpack_verse_id(verse_id)
+            yield verse_id, db.BOOK_NAMES.get(b, ""), c, v, self._text(i)
+
+    def _chapter_slice(self, book, chapter):
+        if not (0 < book <= MAX_BOOK and 0 <= chapter <= MAX_CHAPTER):
+            return 0, 0
+        slot = 2 * (book * (MAX_CHAPTER + 1) + chapter)
+        start, count = self.chapters[slot], self.chapters[slot + 1]
+        return start, start + count
+
+    def verse(self, verse_id):
+        """(verse_id, book, chapter, verse, text) or None."""
+        b, c, v = db.unpack_verse_id(verse_id)
+        lo, hi = self._chapter_slice(b, c)
+        i = lo + v - 1
+        if not (lo <= i < hi and self.ids[i] == verse_id):
+            # Chapters with missing or out-of-order verses fall back to a search.
+            i = bisect_left(self.ids, verse_id, lo, hi)
+            if i >= hi or self.ids[i] != verse_id:
+                return None
+        return next(self._rows(i, i + 1))
+
+    def chapter(self, book, chapter):
+        return list(self._rows(*self._chapter_slice(book, chapter)))
+
+    def last_verse_id(self, start, end):
+        """Largest verse id with start <= verse_id <= end, or None."""
+        hi = bisect_right(self.ids, end)
+        return self.ids[hi - 1] if hi and self.ids[hi - 1] >= start else None
+
+    def range(self, start, end, limit=None):
+        """Rows with start <= verse_id <= end, like db.read_range."""
+        lo = bisect_left(self.ids, start)
+        hi = bisect_right(self.ids, end, lo)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return self._rows(lo, hi)
+
+    def close(self):
+        self.chapters.release()
+        self.ids.release()
+        self.offsets.release()
+        self.mm.close()
+
+_open = {}
+
+def open_corpus(translation, corpus_dir=CORPUS_DIR):
+    """The per-process Corpus for translation, mapped on first use; None if
+    no corpus file has been built for it."""
+    key = (corpus_dir, translation)
+    if key not in _open:
+        path = corpus_path(translation, corpus_dir)
+        if not translation.isalnum() or not os.path.exists(path):
+            return None
+        _open[key] = Corpus(path)
+    return _open[key]
+
+def main():
+    parser = argparse.ArgumentParser(description="Build memory-mapped corpus files from the verses table.")
+    parser.add_argument("--db", default=db.CORPUS_DATABASE, help="corpus database file (default: %(default)s)")
+    parser.add_argument("--out", default=CORPUS_DIR, help="output folder (default: %(default)s)")
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db)
+    for translation, count in sorted(build_all(conn, args.out).items()):
+        print("%s: %d verses" % (translation, count))
+    conn.close()
+
+if __name__ == "__main__":
+    main()
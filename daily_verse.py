@@ -0,0 +1,99 @@
+"""
+Verse of the day.
+
+The curated references in verses.txt and verses_kjv.txt are expanded into a
+date -> verse id rotation table covering ROTATION_YEARS from EPOCH, shuffled
+deterministically per cycle so every worker (and every deploy) agrees on the
+verse for a date. Looking up a day is an index into that table; the text is
+hydrated from the verse store once per translation and kept until midnight.
+"""
+import os
+import random
+import re
+import sqlite3
+from array import array
+from datetime import date
+
+import corpus
+import db
+import references
+
+CURATED_FILES = ("verses.txt", "verses_kjv.txt")
+EPOCH = date(2024, 1, 1)
+ROTATION_YEARS = 20
+
+_REFERENCE = re.compile(r"^(?P<ref>.+?\d+:\d+(?:-\d+)?)\s*(?:-\s*)?(?P<text>.*)$")
+
+def load_curated(paths=None):
+    """(verse_id, fallback text) for every curated reference, in file order."""
+    paths = paths or [os.path.join(db.BASE_DIR, name) for name in CURATED_FILES]
+    curated = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                m = _REFERENCE.match(line.strip())
+                if not m:
+                    continue
+                try:
+                    ref = references.parse(m.group("ref"))[0]
+                except (ValueError, IndexError):
+                    continue
+                curated.setdefault(ref.start, m.group("text").strip())
+    return list(curated.items())
+
+def build_rotation(verse_ids, years=ROTATION_YEARS):
+    """One verse id per day from EPOCH: each pass through the list is a fresh
+    shuffle seeded by the pass number."""
+    days = years * 366
+    table = array("I")
+    cycle = 0
+    while len(table) < days and verse_ids:
+        order = list(verse_ids)
+        random.Random(cycle).shuffle(order)
+        table.extend(order)
+        cycle += 1
+    return table[:days]
+
+class DailyVerse(object):
+
+    def __init__(self, curated=None):
+        curated = curated if curated is not None else load_curated()
+        self.fallback = dict(curated)
+        self.rotation = build_rotation([verse_id for verse_id, _ in curated])
+        self._today = {}
+
+    def verse_id_for(self, day):
+        if not self.rotation:
+            return None
+        return self.rotation[(day - EPOCH).days % len(self.rotation)]
+
+    def get(self, translation, day=None):
+        """(verse_id, "Book C:V - text") for translation on day (default today)."""
+        day = day or date.today()
+        cached = self._today.get(translation)
+        if cached and cached[0] == day:
+            return cached[1]
+        verse_id = self.verse_id_for(day)
+        if verse_id is None:
+            return None, "No verse of the day is configured."
+        text = self._hydrate(translation, verse_id)
+        result = (verse_id, "%s - %s" % (references.format_reference(verse_id, verse_id), text))
+        if day == date.today() and translation in db.TRANSLATIONS:
+            self._today[translation] = (day, result)
+        return result
+
+    def _hydrate(self, translation, verse_id):
+        mapped = corpus.open_corpus(translation)
+        if mapped is not None:
+            row = mapped.verse(verse_id)
+            if row:
+                return row[4]
+        try:
+            row = db.get_corpus_db().execute(
+                "SELECT text FROM verses WHERE translation = ? AND verse_id = ?",
+                (translation, verse_id)).fetchone()
+        except sqlite3.Error:
+            row = None
+        return row[0] if row else self.fallback.get(verse_id, "")
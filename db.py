@@ -0,0 +1,298 @@
+import csv
+import os
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "amplified_pdf-main")
+# Users, favorites and other writes live in DATABASE; the verse corpus is
+# built by ingest.py into CORPUS_DATABASE and only ever read by the app.
+DATABASE = os.environ.get("DATABASE", "app.db")
+CORPUS_DATABASE = os.environ.get("CORPUS_DATABASE", "corpus.db")
+TRANSLATIONS = ("KJV", "WEB", "ASV", "BBE", "YLT")
+
+# ---------------------------
+# Verse ids
+# ---------------------------
+# A verse id packs book, chapter and verse as BBCCCVVV, the same key the
+# bundled scrollmapper databases use: Genesis 1:1 = 01001001 and
+# 01001001-02001005 spans Genesis 1:1 through Exodus 1:5.
+
+def pack_verse_id(book, chapter, verse):
+    return book * 1000000 + chapter * 1000 + verse
+
+def unpack_verse_id(verse_id):
+    return verse_id // 1000000, verse_id // 1000 % 1000, verse_id % 1000
+
+def format_verse_id(verse_id):
+    return "%08d" % verse_id
+
+def chapter_bounds(book, chapter):
+    """First and last possible verse id of a chapter (for BETWEEN queries)."""
+    return pack_verse_id(book, chapter, 0), pack_verse_id(book, chapter, 999)
+
+def load_books():
+    """(id, name, testament, genre_id) rows from csv/key_english.csv."""
+    path = os.path.join(DATA_DIR, "csv", "key_english.csv")
+    with open(path, newline="") as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)
+        return [(int(b), name, testament, int(genre)) for b, name, testament, genre in reader]
+
+def load_genres():
+    """{genre_id: name} from csv/key_genre_english.csv."""
+    path = os.path.join(DATA_DIR, "csv", "key_genre_english.csv")
+    with open(path, newline="") as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)
+        return {int(g): name for g, name in reader}
+
+BOOKS = load_books()
+GENRES = load_genres()
+BOOK_NAMES = {book_id: name for book_id, name, _, _ in BOOKS}
+BOOK_IDS = {name.lower(): book_id for book_id, name, _, _ in BOOKS}
+
+def book_id(book):
+    """Resolve a book number or full book name to its id, or None."""
+    if isinstance(book, int) or str(book).isdigit():
+        book = int(book)
+        return book if book in BOOK_NAMES else None
+    return BOOK_IDS.get(str(book).strip().lower())
+
+# ---------------------------
+# Schema
+# ---------------------------
+
+def init_db(conn):
+    cur = conn.cursor()
+
+    # Users table
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        email TEXT UNIQUE,
+        credits INTEGER DEFAULT 0
+    )
+    """)
+
+    conn.commit()
+
+def init_corpus_db(conn):
+    cur = conn.cursor()
+
+    # Verses table
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS verses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        book TEXT,
+        chapter INTEGER,
+        verse INTEGER,
+        text TEXT,
+        translation TEXT,
+        verse_id INTEGER
+    )
+    """)
+
+    # Source file hashes per ingested book, and the build hash derived from them
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ingest_sources (
+        translation TEXT,
+        book_id INTEGER,
+        path TEXT,
+        sha1 TEXT,
+        verse_count INTEGER,
+        PRIMARY KEY (translation, book_id)
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS corpus_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """)
+
+    migrate_verse_ids(conn)
+    conn.commit()
+
+def migrate_verse_ids(conn):
+    """Add and backfill verses.verse_id on databases created before it existed."""
+    cur = conn.cursor()
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(verses)")]
+    if "verse_id" not in columns:
+        cur.execute("ALTER TABLE verses ADD COLUMN verse_id INTEGER")
+
+    books = [row[0] for row in cur.execute("SELECT DISTINCT book FROM verses WHERE verse_id IS NULL")]
+    for book in books:
+        b = book_id(book)
+        if b is None:
+            continue
+        cur.execute(
+            "UPDATE verses SET verse_id = ? * 1000000 + chapter * 1000 + verse "
+            "WHERE book = ? AND verse_id IS NULL", (b, book))
+
+    create_indexes(conn)
+
+def create_indexes(conn):
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_verses_translation_verse_id "
+        "ON verses (translation, verse_id)")
+
+def drop_indexes(conn):
+    conn.execute("DROP INDEX IF EXISTS idx_verses_translation_verse_id")
+
+# ---------------------------
+# Connections
+# ---------------------------
+# Each worker process keeps one connection per thread to each database, so
+# requests skip connect/schema parsing, reuse the per-connection prepared
+# statement cache and keep a warm page cache. Connections inherited across a
+# fork are never reused.
+
+CACHED_STATEMENTS = 256
+APP_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16384",      # 16 MB
+    "PRAGMA mmap_size = 67108864",     # 64 MB
+)
+CORPUS_PRAGMAS = (
+    "PRAGMA cache_size = -32768",      # 32 MB
+    "PRAGMA mmap_size = 268435456",    # 256 MB
+)
+
+_local = threading.local()
+
+# Called with the seconds spent in each execute, fetch and row iterated on pooled
+# connections, and whether the call ran a statement (execute/executemany)
+# rather than fetching rows of one; metrics.init_app installs it.
+query_observer = None
+
+class TimedCursor(sqlite3.Cursor):
+
+    def _timed(self, method, statement, *args):
+        if query_observer is None:
+            return method(self, *args)
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            query_observer(time.perf_counter() - started, statement)
+
+    def execute(self, *args):
+        return self._timed(sqlite3.Cursor.execute, True, *args)
+
+    def executemany(self, *args):
+        return self._timed(sqlite3.Cursor.executemany, True, *args)
+
+    def fetchone(self):
+        return self._timed(sqlite3.Cursor.fetchone, False)
+
+    def fetchmany(self, *args):
+        return self._timed(sqlite3.Cursor.fetchmany, False, *args)
+
+    def fetchall(self):
+        return self._timed(sqlite3.Cursor.fetchall, False)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # Rows read with "for row in conn.execute(...)" are stepped here.
+        return self._timed(sqlite3.Cursor.__next__, False)
+
+class TimedConnection(sqlite3.Connection):
+
+    def cursor(self, factory=TimedCursor):
+        return super(TimedConnection, self).cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+def _connections():
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    return _local.connections
+
+def get_db():
+    """This thread's read/write connection to DATABASE (WAL mode)."""
+    connections = _connections()
+    conn = connections.get("app")
+    if conn is None:
+        conn = sqlite3.connect(DATABASE, cached_statements=CACHED_STATEMENTS, factory=TimedConnection)
+        for pragma in APP_PRAGMAS:
+            conn.execute(pragma)
+        connections["app"] = conn
+    return conn
+
+def get_corpus_db():
+    """This thread's connection to CORPUS_DATABASE, opened mode=ro&immutable=1
+    so reads take no locks. Immutable readers never see later writes, so
+    ingest.py runs at deploy time, before the workers start. Falls back to
+    DATABASE for single-file setups that still keep verses there."""
+    connections = _connections()
+    conn = connections.get("corpus")
+    if conn is None:
+        if not os.path.exists(CORPUS_DATABASE):
+            return get_db()
+        uri = "file:%s?mode=ro&immutable=1" % pathname2url(os.path.abspath(CORPUS_DATABASE))
+        conn = sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS, factory=TimedConnection)
+        for pragma in CORPUS_PRAGMAS:
+            conn.execute(pragma)
+        connections["corpus"] = conn
+    return conn
+
+# ---------------------------
+# Reads
+# ---------------------------
+
+def translation_filter(translations):
+    """(" WHERE translation IN (...)", params) limiting a verses query to
+    translations, or ("", ()) for all of them when translations is None."""
+    if translations is None:
+        return "", ()
+    translations = tuple(sorted(translations))
+    return " WHERE translation IN (%s)" % ", ".join("?" * len(translations)), translations
+
+def read_range(conn, translation, start, end, limit=None):
+    """Verses of one translation with start <= verse_id <= end, in order.
+
+    Served by an index seek on (translation, verse_id); rows are
+    (verse_id, book, chapter, verse, text).
+    """
+    sql = ("SELECT verse_id, book, chapter, verse, text FROM verses "
+           "WHERE translation = ? AND verse_id BETWEEN ? AND ? ORDER BY verse_id")
+    params = (translation, start, end)
+    if limit is not None:
+        sql += " LIMIT ?"
+        params += (limit,)
+    return conn.execute(sql, params)
+
+def last_verse_id(conn, translation, start, end):
+    """Largest verse id of one translation with start <= verse_id <= end, or
+    None; one index seek on (translation, verse_id)."""
+    return conn.execute("SELECT MAX(verse_id) FROM verses WHERE translation = ? AND verse_id BETWEEN ? AND ?",
+                        (translation, start, end)).fetchone()[0]
+
+def read_parallel(conn, translations, start, end, limit=None):
+    """Rows of several translations over one verse-id span in a single query.
+
+    The IN list is answered with one (translation, verse_id) index seek per
+    translation; rows are (verse_id, translation, book, chapter, verse, text)
+    ordered by verse id.
+    """
+    sql = ("SELECT verse_id, translation, book, chapter, verse, text FROM verses "
+           "WHERE translation IN (%s) AND verse_id BETWEEN ? AND ? ORDER BY verse_id"
+           % ", ".join("?" * len(translations)))
+    params = tuple(translations) + (start, end)
+    if limit is not None:
+        sql += " LIMIT ?"
+        params += (limit,)
+    return conn.execute(sql, params)
@@ -0,0 +1,119 @@
+"""
+Bulk export of a translation, or a verse id range of one, as CSV, a JSON
+array or NDJSON.
+
+Rows come lazily off the memory-mapped corpus file (or a database cursor
+without one) and are encoded and, optionally, gzip-compressed chunk by chunk,
+so an export never holds more than one chunk in memory. The byte stream for
+a given build and request is deterministic, which is what lets a download be
+resumed with a Range request: the stream is regenerated and the bytes before
+the range skipped. The complete length a Range needs is measured by one
+counting pass and remembered for the build.
+"""
+import csv
+import io
+import json
+import zlib
+
+import corpus
+import db
+
+FORMATS = {
+    "csv": "text/csv",
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+CHUNK_SIZE = 64 * 1024
+GZIP_LEVEL = 6
+FIRST_VERSE, LAST_VERSE = 0, 99999999
+
+_lengths = {}
+MAX_LENGTHS = 1024
+
+def rows(translation, start=FIRST_VERSE, end=LAST_VERSE):
+    """(verse_id, book, chapter, verse, text) in verse id order."""
+    mapped = corpus.open_corpus(translation)
+    if mapped is not None:
+        return mapped.range(start, end)
+    return _cursor_rows(translation, start, end)
+
+def _cursor_rows(translation, start, end):
+    cur = db.read_range(db.get_corpus_db(), translation, start, end)
+    try:
+        cur.arraysize = 500
+        while True:
+            batch = cur.fetchmany()
+            if not batch:
+                break
+            yield from batch
+    finally:
+        cur.close()
+
+# ---------------------------
+# Encoders
+# ---------------------------
+
+def _record(row):
+    verse_id, book, chapter, verse, text = row
+    return {"id": db.format_verse_id(verse_id), "book": book, "chapter": chapter, "verse": verse, "text": text}
+
+def _csv(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(("id", "book", "chapter", "verse", "text"))
+    for verse_id, book, chapter, verse, text in rows:
+        writer.writerow((db.format_verse_id(verse_id), book, chapter, verse, text))
+        if buf.tell() >= CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def _ndjson(rows):
+    parts, size = [], 0
+    for row in rows:
+        line = json.dumps(_record(row), ensure_ascii=False) + "\n"
+        parts.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield "".join(parts)
+            parts, size = [], 0
+    yield "".join(parts)
+
+def _json(rows):
+    yield "["
+    separator = "\n"
+    for chunk in _ndjson(rows):
+        if chunk:
+            yield separator + chunk[:-1].replace("\n", ",\n")
+            separator = ",\n"
+    yield "\n]\n"
+
+_ENCODERS = {"csv": _csv, "json": _json, "ndjson": _ndjson}
+
+def gzipped(chunks, level=GZIP_LEVEL):
+    # wbits=31 writes a gzip header with a zero mtime, so the same input
+    # always compresses to the same bytes.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+def stream(fmt, translation, start=FIRST_VERSE, end=LAST_VERSE, gzip=False):
+    """The export as an iterator of byte chunks."""
+    chunks = (chunk.encode("utf-8") for chunk in _ENCODERS[fmt](rows(translation, start, end)) if chunk)
+    return gzipped(chunks) if gzip else chunks
+
+def length(build_hash, fmt, translation, start=FIRST_VERSE, end=LAST_VERSE, gzip=False):
+    """Total bytes of stream(...), counted once per build and kept."""
+    key = (build_hash, fmt, translation, start, end, gzip)
+    if key not in _lengths:
+        if len(_lengths) >= MAX_LENGTHS:
+            _lengths.clear()
+        _lengths[key] = sum(len(chunk) for chunk in stream(fmt, translation, start, end, gzip))
+    return _lengths[key]
+
+def known_length(build_hash, fmt, translation, start=FIRST_VERSE, end=LAST_VERSE, gzip=False):
+    return _lengths.get((build_hash, fmt, translation, start, end, gzip))
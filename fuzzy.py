@@ -0,0 +1,134 @@
+"""
+Typo-tolerant search: misspelled query words are expanded into the corpus
+words within a small edit distance before the full-text lookup, e.g.
+"Nebuchadnezar" -> nebuchadnezzar, "Melchizedek" -> melchizedek, melchisedec.
+
+The vocabulary of all translations is indexed by padded trigrams ("$ne",
+"neb", ..., "ar$") in corpus.db at ingest. A lookup reads only the rows of
+the query word's own trigrams, keeps the words sharing enough of them to be
+within the edit budget (each edit can break at most four trigrams), and
+checks those with a banded edit distance. Nothing is held in memory between
+queries.
+"""
+from array import array
+
+import vocabulary
+
+MAX_EXPANSIONS = 5
+MAX_CANDIDATES = 200
+MIN_LENGTH = 4
+
+# ---------------------------
+# Index
+# ---------------------------
+
+def trigrams(term):
+    padded = "$%s$" % term
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def build(conn):
+    """Rebuild fuzzy_terms / fuzzy_grams from the vocabulary table."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS fuzzy_terms (
+        id INTEGER PRIMARY KEY,
+        term TEXT NOT NULL,
+        count INTEGER NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS fuzzy_grams (
+        gram TEXT PRIMARY KEY,
+        ids BLOB NOT NULL
+    )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_fuzzy_terms_term ON fuzzy_terms (term)")
+    conn.execute("DELETE FROM fuzzy_terms")
+    conn.execute("DELETE FROM fuzzy_grams")
+    terms = conn.execute("SELECT term, SUM(count) FROM vocabulary GROUP BY term ORDER BY term").fetchall()
+    conn.executemany("INSERT INTO fuzzy_terms (id, term, count) VALUES (?, ?, ?)",
+                     ((i, term, n) for i, (term, n) in enumerate(terms)))
+    grams = {}
+    for i, (term, _) in enumerate(terms):
+        for gram in trigrams(term):
+            grams.setdefault(gram, array("I")).append(i)
+    conn.executemany("INSERT INTO fuzzy_grams (gram, ids) VALUES (?, ?)",
+                     ((gram, ids.tobytes()) for gram, ids in grams.items()))
+
+def has_index(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'fuzzy_grams'").fetchone() is not None
+
+# ---------------------------
+# Lookup
+# ---------------------------
+
+def edit_budget(term):
+    """Edits allowed for a word of this length."""
+    if len(term) < MIN_LENGTH:
+        return 0
+    return 1 if len(term) < 8 else 2
+
+def edit_distance(a, b, limit):
+    """Edit distance between a and b counting a swap of neighbouring letters
+    as one edit, or limit + 1 once it must exceed limit. Only the diagonal
+    band of width 2 * limit + 1 is computed."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    over = limit + 1
+    before, previous = None, [j if j <= limit else over for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        lo, hi = max(1, i - limit), min(len(b), i + limit)
+        current = [over] * (len(b) + 1)
+        current[0] = i if i <= limit else over
+        for j in range(lo, hi + 1):
+            cost = a[i - 1] != b[j - 1]
+            d = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if cost and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                d = min(d, before[j - 2] + 1)
+            current[j] = d
+        if min(current[lo - 1:hi + 1]) > limit:
+            return over
+        before, previous = previous, current
+    return min(previous[-1], over)
+
+def similar(conn, term, budget=None, limit=MAX_EXPANSIONS):
+    """Corpus words within budget edits of term, closest and most frequent
+    first, as (word, distance, count)."""
+    budget = edit_budget(term) if budget is None else budget
+    grams = trigrams(term)
+    shared = {}
+    placeholders = ", ".join("?" * len(grams))
+    for (ids,) in conn.execute("SELECT ids FROM fuzzy_grams WHERE gram IN (%s)" % placeholders, list(grams)):
+        for i in array("I", ids):
+            shared[i] = shared.get(i, 0) + 1
+    # q-gram lemma: one edit (a swap included) changes at most four trigrams.
+    need = max(len(grams) - 4 * budget, 1)
+    # Words sharing the most trigrams are checked first, and at most MAX_CANDIDATES.
+    candidates = sorted((i for i, n in shared.items() if n >= need), key=shared.get, reverse=True)
+    candidates = candidates[:MAX_CANDIDATES]
+    if not candidates:
+        return []
+    found = []
+    for word, count in conn.execute(
+            "SELECT term, count FROM fuzzy_terms WHERE id IN (%s)" % ", ".join("?" * len(candidates)), candidates):
+        distance = edit_distance(term, word, budget)
+        if distance <= budget:
+            found.append((word, distance, count))
+    found.sort(key=lambda item: (item[1], -item[2]))
+    return found[:limit]
+
+def expand(conn, query, all_terms=False):
+    """{query word: [corpus words to search for instead]} for the words of
+    query that are not in the corpus (every word when all_terms). Words
+    with no close match are left out."""
+    if not has_index(conn):
+        return {}
+    expansions = {}
+    for term in dict.fromkeys(vocabulary.words(query)):
+        known = conn.execute("SELECT 1 FROM fuzzy_terms WHERE term = ?", (term,)).fetchone()
+        if known and not all_terms:
+            continue
+        words = [word for word, _, _ in similar(conn, term)]
+        if words:
+            expansions[term] = words
+    return expansions
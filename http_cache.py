@@ -0,0 +1,86 @@
+import hashlib
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from flask import Response, make_response, request, session
+
+import db
+
+# Corpus pages may be reused for this long without revalidating. URLs that
+# carry the current build as ?v=<build hash> never change and are immutable.
+CORPUS_MAX_AGE = 3600
+IMMUTABLE_MAX_AGE = 31536000
+
+_build = None
+
+def corpus_build():
+    """(build_hash, built_at datetime) recorded by ingest.py, read once per
+    process; (None, None) before the corpus has been ingested."""
+    global _build
+    if _build is None:
+        try:
+            meta = dict(db.get_corpus_db().execute(
+                "SELECT key, value FROM corpus_meta WHERE key IN ('build_hash', 'built_at')"))
+        except sqlite3.Error:
+            meta = {}
+        built_at = meta.get("built_at")
+        _build = (meta.get("build_hash"),
+                  datetime.fromtimestamp(int(built_at), timezone.utc) if built_at else None)
+    return _build
+
+def seconds_until_midnight():
+    now = datetime.now()
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return max(int((midnight - now).total_seconds()), 1)
+
+def corpus_cached(daily=False):
+    """Serve a GET view's response with a strong ETag derived from the corpus
+    build hash, and answer matching If-None-Match / If-Modified-Since with a
+    304 before the view (and the database) is touched.
+
+    daily=True is for views whose output also changes at local midnight: the
+    date joins the ETag and max-age stops at midnight.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            build_hash, built_at = corpus_build()
+            if not build_hash or request.method not in ("GET", "HEAD"):
+                return view(*args, **kwargs)
+
+            # The navbar differs for signed-in users, so their copies stay private.
+            private = "user_id" in session
+            parts = [build_hash, request.full_path, "u" if private else ""]
+            if daily:
+                parts.append(time.strftime("%Y-%m-%d"))
+            etag = hashlib.sha1("|".join(parts).encode()).hexdigest()[:24]
+
+            if daily:
+                cache_control = "%s, max-age=%d" % ("private" if private else "public", seconds_until_midnight())
+            elif private:
+                cache_control = "private, no-cache"
+            elif request.args.get("v") == build_hash:
+                cache_control = "public, max-age=%d, immutable" % IMMUTABLE_MAX_AGE
+            else:
+                cache_control = "public, max-age=%d" % CORPUS_MAX_AGE
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = bool(since and built_at and not daily and built_at <= since)
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if built_at and not daily:
+                response.last_modified = built_at
+            response.headers["Cache-Control"] = cache_control
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,191 @@
+"""
+Load the plain-text translations in amplified_pdf-main/txt into the verses table
+of the corpus database (corpus.db).
+
+    python ingest.py                      # every translation found under txt/
+    python ingest.py KJV WEB --force      # reload selected translations
+
+Each book file ("1 Genesis - King James Version (KJV).txt") holds one
+"[chapter:verse] text" line per verse. Files are hashed and parsed in a process
+pool, and books whose hash matches the last import are skipped. Changed books
+are written with executemany in a single transaction with bulk-load PRAGMAs,
+and the (translation, verse_id) index, the FTS5 search index, the vocabulary
+counts with their trigram and positional indexes, the concordance, the
+memory-mapped corpus files and the offline bundles are rebuilt after the load;
+vocabulary, postings and concordance rows only for the translations that
+changed.
+"""
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bundles
+import concordance
+import corpus
+import db
+import fuzzy
+import positions
+import search
+import vocabulary
+
+TXT_DIR = os.path.join(db.DATA_DIR, "txt")
+VERSE_LINE = re.compile(r"^\[(\d+):(\d+)\]\s?(.*)$")
+
+IMPORT_PRAGMAS = (
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -262144",   # 256 MB
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA locking_mode = EXCLUSIVE",
+)
+
+def find_book_files(source_dir, translations=None):
+    """Yield (translation, book_id, path) for every numbered book file."""
+    for translation in sorted(os.listdir(source_dir)):
+        folder = os.path.join(source_dir, translation)
+        if not os.path.isdir(folder) or (translations and translation not in translations):
+            continue
+        for name in os.listdir(folder):
+            prefix = name.split(" ", 1)[0]
+            if name.endswith(".txt") and prefix.isdigit() and int(prefix) in db.BOOK_NAMES:
+                yield translation, int(prefix), os.path.join(folder, name)
+
+def file_sha1(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def parse_book(translation, book_id, path):
+    """Parse one book file into verses rows (runs in a worker process)."""
+    book = db.BOOK_NAMES[book_id]
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            m = VERSE_LINE.match(line.rstrip("\r\n"))
+            if not m:
+                continue
+            chapter, verse = int(m.group(1)), int(m.group(2))
+            rows.append((book, chapter, verse, m.group(3).strip(), translation,
+                         db.pack_verse_id(book_id, chapter, verse)))
+    return translation, book_id, rows
+
+def _hash_job(job):
+    translation, book_id, path = job
+    return translation, book_id, path, file_sha1(path)
+
+def _parse_job(job):
+    return parse_book(*job)
+
+def update_build_hash(conn):
+    """Derive the corpus build hash from the source hashes of every loaded book."""
+    digest = hashlib.sha1()
+    for translation, book_id, sha1 in conn.execute(
+            "SELECT translation, book_id, sha1 FROM ingest_sources ORDER BY translation, book_id"):
+        digest.update(("%s:%d:%s\n" % (translation, book_id, sha1)).encode())
+    build_hash = digest.hexdigest()[:16]
+    conn.executemany("INSERT OR REPLACE INTO corpus_meta (key, value) VALUES (?, ?)",
+                     [("build_hash", build_hash), ("built_at", str(int(time.time())))])
+    return build_hash
+
+def ingest(database=db.CORPUS_DATABASE, source_dir=TXT_DIR, translations=None, force=False, workers=None,
+           corpus_dir=corpus.CORPUS_DIR, bundle_dir=bundles.BUNDLE_DIR):
+    started = time.time()
+    conn = sqlite3.connect(database)
+    db.init_corpus_db(conn)
+
+    jobs = list(find_book_files(source_dir, translations))
+    known = {(t, b): sha1 for t, b, sha1 in
+             conn.execute("SELECT translation, book_id, sha1 FROM ingest_sources")}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        hashed = list(pool.map(_hash_job, jobs, chunksize=16))
+        changed = [(t, b, path, sha1) for t, b, path, sha1 in hashed
+                   if force or known.get((t, b)) != sha1]
+        if not changed:
+            if not all(os.path.exists(corpus.corpus_path(t, corpus_dir)) for t, _, _ in jobs):
+                corpus.build_all(conn, corpus_dir)
+            if not os.path.exists(os.path.join(bundle_dir, bundles.MANIFEST)):
+                bundles.build_all(conn, bundle_dir)
+            if not search.has_index(conn):
+                with conn:
+                    search.build_index(conn)
+            if not vocabulary.has_vocabulary(conn):
+                with conn:
+                    vocabulary.build(conn, pool.map)
+            if not fuzzy.has_index(conn):
+                with conn:
+                    fuzzy.build(conn)
+            if not positions.has_index(conn):
+                with conn:
+                    positions.build(conn, pool.map)
+            if not concordance.has_index(conn):
+                with conn:
+                    concordance.build(conn, pool.map)
+            print("Corpus is up to date (%d books checked)." % len(hashed))
+            conn.close()
+            return 0
+
+        # Clear stale rows while the index can still find them, then load without it.
+        for t, b, _, _ in changed:
+            lo, hi = db.pack_verse_id(b, 0, 0), db.pack_verse_id(b, 999, 999)
+            conn.execute("DELETE FROM verses WHERE translation = ? AND verse_id BETWEEN ? AND ?",
+                         (t, lo, hi))
+        conn.commit()
+        for pragma in IMPORT_PRAGMAS:
+            conn.execute(pragma)
+        db.drop_indexes(conn)
+
+        sources = {(t, b): (path, sha1) for t, b, path, sha1 in changed}
+        total = 0
+        with conn:
+            for translation, book_id, rows in pool.map(
+                    _parse_job, [(t, b, path) for t, b, path, _ in changed], chunksize=4):
+                conn.executemany(
+                    "INSERT INTO verses (book, chapter, verse, text, translation, verse_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", rows)
+                path, sha1 = sources[(translation, book_id)]
+                conn.execute(
+                    "INSERT OR REPLACE INTO ingest_sources "
+                    "(translation, book_id, path, sha1, verse_count) VALUES (?, ?, ?, ?, ?)",
+                    (translation, book_id, os.path.relpath(path, source_dir), sha1, len(rows)))
+                total += len(rows)
+            # Only translations with a changed book are recounted and reindexed;
+            # the fuzzy index spans every translation but is built from the
+            # vocabulary table, not the verses.
+            reindex = {t for t, _, _, _ in changed}
+            vocabulary.build(conn, pool.map, reindex)
+            fuzzy.build(conn)
+            positions.build(conn, pool.map, reindex)
+            concordance.build(conn, pool.map, reindex)
+
+    with conn:
+        db.create_indexes(conn)
+        search.build_index(conn)
+        build_hash = update_build_hash(conn)
+    corpus.build_all(conn, corpus_dir)
+    bundles.build_all(conn, bundle_dir)
+    conn.execute("PRAGMA optimize")
+    conn.close()
+
+    print("Loaded %d verses from %d of %d books in %.1fs (build %s)."
+          % (total, len(changed), len(hashed), time.time() - started, build_hash))
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description="Load txt/ translations into the verses table.")
+    parser.add_argument("translations", nargs="*", help="translation folders to load (default: all)")
+    parser.add_argument("--db", default=db.CORPUS_DATABASE, help="corpus database file (default: %(default)s)")
+    parser.add_argument("--source", default=TXT_DIR, help="folder of translation folders")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="reload books even if unchanged")
+    parser.add_argument("--corpus-dir", default=corpus.CORPUS_DIR, help="memory-mapped corpus output folder")
+    parser.add_argument("--bundle-dir", default=bundles.BUNDLE_DIR, help="offline bundle output folder")
+    args = parser.parse_args()
+    ingest(args.db, args.source, set(args.translations) or None, args.force, args.workers, args.corpus_dir,
+           args.bundle_dir)
+
+if __name__ == "__main__":
+    main()
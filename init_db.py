@@ -1,32 +1,17 @@
 import sqlite3
 
-# Connect to SQLite database (creates app.db if it doesn't exist)
-conn = sqlite3.connect("app.db")
-cur = conn.cursor()
+import db
 
-# Users table: stores name, email, and credits
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT,
-    email TEXT UNIQUE,
-    credits INTEGER DEFAULT 0
-)
-""")
-
-# Verses table: optional, if you want to move verses from .txt into DB
-cur.execute("""
-CREATE TABLE IF NOT EXISTS verses (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    book TEXT,
-    chapter INTEGER,
-    verse INTEGER,
-    text TEXT,
-    translation TEXT
-)
-""")
+# Connect to SQLite database (creates app.db if it doesn't exist).
+# app.db holds the users table; the verses corpus lives in corpus.db, which
+# ingest.py fills. On an existing corpus database this also adds the packed
+# verse_id column and the (translation, verse_id) index.
+conn = sqlite3.connect(db.DATABASE)
+db.init_db(conn)
+conn.close()
 
-conn.commit()
+conn = sqlite3.connect(db.CORPUS_DATABASE)
+db.init_corpus_db(conn)
 conn.close()
 
 print("Database setup complete! Tables created.")
@@ -0,0 +1,176 @@
+"""
+In-process request metrics, exposed in Prometheus text format at /metrics.
+
+Per endpoint: a latency histogram, responses by status, and SQL statement
+counts and time. Per template: render time. Request counts are also kept in
+rolling windows at the same precisions as RedisConnection.update_counter
+(1s, 1m, 5m, 1h, 5h, 1d). Everything is plain counters behind one lock, so
+it is cheap enough to leave on in production; each worker reports its own
+numbers.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, before_render_template, g, has_request_context, request, template_rendered
+
+import db
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PRECISION = [1, 60, 300, 3600, 18000, 86400]
+
+_lock = threading.Lock()
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield '%s_bucket{%s,le="%s"} %d' % (name, labels, le, cumulative)
+        yield "%s_sum{%s} %.6f" % (name, labels, self.sum)
+        yield "%s_count{%s} %d" % (name, labels, self.count)
+
+_latency = {}          # endpoint -> Histogram
+_responses = {}        # (endpoint, status) -> count
+_sql_queries = {}      # endpoint -> statements executed
+_sql_seconds = {}      # endpoint -> seconds spent in SQLite
+_render = {}           # template -> Histogram
+_windows = {}          # (endpoint, precision) -> [window start, count]
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+# ---------------------------
+# Collection
+# ---------------------------
+
+def _on_query(seconds, statement=True):
+    if has_request_context() and "metrics_start" in g:
+        if statement:
+            g.sql_queries += 1
+        g.sql_seconds += seconds
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+    g.render_started = {}
+
+def _after_request(response):
+    if "metrics_start" not in g:
+        return response
+    endpoint = request.endpoint or "unmatched"
+    if response.is_streamed:
+        # The body, and the SQL behind it, is produced after this hook runs:
+        # record once it has been sent, from this request's g.
+        state = g._get_current_object()
+        response.call_on_close(lambda: _record(endpoint, response.status_code, state))
+    else:
+        _record(endpoint, response.status_code, g)
+    return response
+
+def _record(endpoint, status, state):
+    elapsed = time.perf_counter() - state.metrics_start
+    now = int(time.time())
+    with _lock:
+        _latency.setdefault(endpoint, Histogram()).observe(elapsed)
+        key = (endpoint, status)
+        _responses[key] = _responses.get(key, 0) + 1
+        _sql_queries[endpoint] = _sql_queries.get(endpoint, 0) + state.sql_queries
+        _sql_seconds[endpoint] = _sql_seconds.get(endpoint, 0.0) + state.sql_seconds
+        for prec in PRECISION:
+            pnow = now // prec * prec
+            window = _windows.setdefault((endpoint, prec), [pnow, 0])
+            if window[0] != pnow:
+                window[0], window[1] = pnow, 0
+            window[1] += 1
+
+def _before_render(sender, template, context, **extra):
+    if has_request_context() and "render_started" in g:
+        g.render_started[template.name] = time.perf_counter()
+
+def _rendered(sender, template, context, **extra):
+    if not has_request_context() or "render_started" not in g:
+        return
+    started = g.render_started.pop(template.name, None)
+    if started is not None:
+        with _lock:
+            _render.setdefault(template.name, Histogram()).observe(time.perf_counter() - started)
+
+def init_app(app, cache_stats=None):
+    """Install the request hooks and the /metrics endpoint. cache_stats is an
+    optional callable returning RenderCache.stats()."""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    db.query_observer = _on_query
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(render(cache_stats() if cache_stats else None),
+                        mimetype="text/plain; version=0.0.4")
+
+# ---------------------------
+# Exposition
+# ---------------------------
+
+def render(cache_stats=None):
+    lines = []
+    with _lock:
+        lines += ["# HELP bible_request_duration_seconds Request latency by endpoint.",
+                  "# TYPE bible_request_duration_seconds histogram"]
+        for endpoint, hist in sorted(_latency.items()):
+            lines += hist.lines("bible_request_duration_seconds", 'endpoint="%s"' % _label(endpoint))
+
+        lines += ["# HELP bible_responses_total Responses by endpoint and status.",
+                  "# TYPE bible_responses_total counter"]
+        for (endpoint, status), n in sorted(_responses.items()):
+            lines.append('bible_responses_total{endpoint="%s",status="%d"} %d' % (_label(endpoint), status, n))
+
+        lines += ["# HELP bible_sql_queries_total SQL statements executed by endpoint.",
+                  "# TYPE bible_sql_queries_total counter"]
+        for endpoint, n in sorted(_sql_queries.items()):
+            lines.append('bible_sql_queries_total{endpoint="%s"} %d' % (_label(endpoint), n))
+        lines += ["# HELP bible_sql_seconds_total Time spent in SQLite by endpoint.",
+                  "# TYPE bible_sql_seconds_total counter"]
+        for endpoint, seconds in sorted(_sql_seconds.items()):
+            lines.append('bible_sql_seconds_total{endpoint="%s"} %.6f' % (_label(endpoint), seconds))
+
+        lines += ["# HELP bible_template_render_seconds Jinja render time by template.",
+                  "# TYPE bible_template_render_seconds histogram"]
+        for name, hist in sorted(_render.items()):
+            lines += hist.lines("bible_template_render_seconds", 'template="%s"' % _label(name))
+
+        now = int(time.time())
+        lines += ["# HELP bible_requests_window Requests in the current window of each precision (seconds).",
+                  "# TYPE bible_requests_window gauge"]
+        for (endpoint, prec), (start, n) in sorted(_windows.items()):
+            current = n if start == now // prec * prec else 0
+            lines.append('bible_requests_window{endpoint="%s",precision="%d"} %d' % (_label(endpoint), prec, current))
+
+    if cache_stats:
+        lines += ["# HELP bible_render_cache_lookups_total Rendered page cache lookups by result.",
+                  "# TYPE bible_render_cache_lookups_total counter"]
+        for result in ("hits", "l2_hits", "misses"):
+            lines.append('bible_render_cache_lookups_total{result="%s"} %d' % (result, cache_stats[result]))
+        lines += ["# TYPE bible_render_cache_evictions_total counter",
+                  "bible_render_cache_evictions_total %d" % cache_stats["evictions"],
+                  "# TYPE bible_render_cache_bytes gauge",
+                  "bible_render_cache_bytes %d" % cache_stats["bytes"],
+                  "# TYPE bible_render_cache_hit_ratio gauge",
+                  "bible_render_cache_hit_ratio %s" % cache_stats["hit_ratio"]]
+    return "\n".join(lines) + "\n"
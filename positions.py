@@ -0,0 +1,398 @@
+"""
+Positional inverted index for phrase and proximity (NEAR) search.
+
+One postings row per (translation, term) in corpus.db, built at ingest with
+the vocabulary.py tokenizer. A row holds two uint32 arrays:
+
+    data    per verse: verse id delta, position count, position deltas
+    skips   (first verse id, offset into data) of every BLOCK verses
+
+Verse ids restart from zero at each block, so any block decodes on its own.
+A query walks the rarest term's verses in order and seeks every other term
+forward through its skip table, decoding only the blocks it lands in, and
+stops as soon as the requested page is full. Where a page ended is kept per
+query, so the next page carries on from there instead of walking the earlier
+pages again, and no search walks more than MAX_SCAN verses.
+"""
+import gc
+import threading
+from array import array
+from bisect import bisect_right
+from collections import Counter, OrderedDict
+
+from markupsafe import Markup, escape
+
+import corpus
+import db
+import vocabulary
+from http_cache import corpus_build
+
+BLOCK = 16
+DEFAULT_DISTANCE = 5
+MAX_DISTANCE = 50
+MAX_TERMS = 8
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+ENTRY_BYTES = 128     # charged per cached row on top of its arrays, so misses count too
+MAX_SCAN = 2000       # verses of the rarest term walked per search
+CHECKPOINT_QUERIES = 256
+CHECKPOINTS_PER_QUERY = 64
+MODES = ("phrase", "near")
+
+# ---------------------------
+# Build
+# ---------------------------
+
+def encode(entries):
+    """(data, skips) arrays for [(verse_id, [positions])] in verse id order."""
+    data, skips = [], []
+    prev = 0
+    for i, (verse_id, positions) in enumerate(entries):
+        if i % BLOCK == 0:
+            skips += (verse_id, len(data))
+            prev = 0
+        data += (verse_id - prev, len(positions))
+        if len(positions) == 1:
+            data.append(positions[0])
+        else:
+            data += [p - q for q, p in zip([0] + positions, positions)]
+        prev = verse_id
+    return array("I", data), array("I", skips)
+
+def index_translation(rows):
+    """Postings of one translation from (verse_id, text) rows in verse id
+    order: [(term, verses, data bytes, skips bytes)]. Runs in the ingest pool."""
+    # Millions of small lists and no cycles: the collector would only slow this down.
+    gc.disable()
+    try:
+        return _index_translation(rows)
+    finally:
+        gc.enable()
+
+def _index_translation(rows):
+    postings = {}
+    for verse_id, text in rows:
+        verse = {}
+        for position, term in enumerate(vocabulary.words(text)):
+            if term in verse:
+                verse[term].append(position)
+            else:
+                verse[term] = [position]
+        for term, found in verse.items():
+            if term in postings:
+                postings[term].append((verse_id, found))
+            else:
+                postings[term] = [(verse_id, found)]
+    out = []
+    for term, entries in postings.items():
+        data, skips = encode(entries)
+        out.append((term, len(entries), data.tobytes(), skips.tobytes()))
+    return out
+
+def build(conn, map=map, translations=None):
+    """Rebuild the postings table, one translation per call of map; with
+    translations, only their rows unless the table is new."""
+    if not has_index(conn):
+        translations = None
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS postings (
+        id INTEGER PRIMARY KEY,
+        translation TEXT NOT NULL,
+        term TEXT NOT NULL,
+        verses INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        skips BLOB NOT NULL
+    )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_postings_translation_term ON postings (translation, term)")
+    where, params = db.translation_filter(translations)
+    conn.execute("DELETE FROM postings" + where, params)
+    rows = {}
+    for translation, verse_id, text in conn.execute(
+            "SELECT translation, verse_id, text FROM verses%s ORDER BY translation, verse_id" % where, params):
+        rows.setdefault(translation, []).append((verse_id, text))
+    for translation, postings in zip(rows, map(index_translation, rows.values())):
+        conn.executemany("INSERT INTO postings (translation, term, verses, data, skips) VALUES (?, ?, ?, ?, ?)",
+                         ((translation,) + row for row in postings))
+
+def has_index(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'postings'").fetchone() is not None
+
+# ---------------------------
+# Postings
+# ---------------------------
+
+class Postings(object):
+    """Decoded view of one postings row."""
+
+    def __init__(self, verses, data, skips):
+        self.verses = verses
+        self.data = array("I")
+        self.data.frombytes(data)
+        skips = array("I", skips)
+        self.block_ids = skips[0::2]
+        self.block_offsets = skips[1::2]
+
+    def _decode(self, block):
+        start = self.block_offsets[block]
+        end = self.block_offsets[block + 1] if block + 1 < len(self.block_offsets) else len(self.data)
+        data, i, verse_id, out = self.data, start, 0, []
+        while i < end:
+            verse_id += data[i]
+            n = data[i + 1]
+            positions, p = [], 0
+            for delta in data[i + 2:i + 2 + n]:
+                p += delta
+                positions.append(p)
+            out.append((verse_id, positions))
+            i += 2 + n
+        return out
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+    def iter_from(self, verse_id):
+        """(verse_id, positions) from the block holding verse_id onwards."""
+        for block in range(max(bisect_right(self.block_ids, verse_id) - 1, 0), len(self.block_offsets)):
+            yield from self._decode(block)
+
+    def cursor(self):
+        return PostingsCursor(self)
+
+    @property
+    def nbytes(self):
+        return (len(self.data) + len(self.block_ids) + len(self.block_offsets)) * self.data.itemsize
+
+class PostingsCursor(object):
+    """Forward-only seek by verse id; keeps the last decoded block."""
+
+    def __init__(self, postings):
+        self.postings = postings
+        self.block = -1
+        self.entries = {}
+
+    def seek(self, verse_id):
+        """Positions of the term in verse_id, or None."""
+        block = bisect_right(self.postings.block_ids, verse_id, max(self.block, 0)) - 1
+        if block < 0:
+            return None
+        if block != self.block:
+            self.block = block
+            self.entries = dict(self.postings._decode(block))
+        return self.entries.get(verse_id)
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+
+def _size(postings):
+    return ENTRY_BYTES + (postings.nbytes if postings is not None else 0)
+
+def load(conn, translation, term):
+    """Postings for term in translation (None if it never occurs), with the
+    most recently used rows of the current build kept decoded, up to
+    CACHE_MAX_BYTES of decoded arrays."""
+    global _cache_bytes
+    key = (corpus_build()[0], translation, term)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    row = conn.execute("SELECT verses, data, skips FROM postings WHERE translation = ? AND term = ?",
+                       (translation, term)).fetchone()
+    postings = Postings(*row) if row else None
+    size = _size(postings)
+    if size > CACHE_MAX_BYTES:
+        return postings
+    with _lock:
+        if key in _cache:
+            _cache_bytes -= _size(_cache.pop(key))
+        _cache[key] = postings
+        _cache_bytes += size
+        while _cache_bytes > CACHE_MAX_BYTES:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= _size(evicted)
+    return postings
+
+# ---------------------------
+# Matching
+# ---------------------------
+
+def phrase_match(positions):
+    """Start positions where the terms follow each other in order."""
+    starts = set(positions[0])
+    for i, plist in enumerate(positions[1:], 1):
+        if not starts:
+            break
+        starts.intersection_update([p - i for p in plist])
+    return sorted(starts)
+
+def near_match(positions, distance):
+    """(first, last) of the narrowest windows holding every term once, in any
+    order, with at most distance other words between the outermost two."""
+    merged = sorted((p, i) for i, plist in enumerate(positions) for p in plist)
+    need = len(positions)
+    counts = [0] * need
+    have = lo = 0
+    windows = []
+    for p, i in merged:
+        counts[i] += 1
+        if counts[i] == 1:
+            have += 1
+        while have == need:
+            first, j = merged[lo]
+            # Words between the outermost two, less the terms in between.
+            if p - first - 1 - (need - 2) <= distance:
+                windows.append((first, p))
+            counts[j] -= 1
+            if counts[j] == 0:
+                have -= 1
+            lo += 1
+    return windows
+
+def _matches(conn, translation, terms, mode, distance, lo, hi):
+    """(verse_id, highlighted positions or None) for every verse of the
+    rarest term in lo..hi, in verse id order."""
+    postings = [load(conn, translation, term) for term in terms]
+    if not postings or any(p is None for p in postings):
+        return
+    unique = sorted(set(terms), key=lambda t: postings[terms.index(t)].verses)
+    driver = postings[terms.index(unique[0])]
+    cursors = {t: postings[terms.index(t)].cursor() for t in unique[1:]}
+    # A phrase repeating a word ("the the") needs that many positions of it.
+    repeated = [(t, n) for t, n in Counter(terms).items() if n > 1]
+    for verse_id, driver_positions in driver.iter_from(lo):
+        if verse_id < lo:
+            continue
+        if verse_id > hi:
+            break
+        marked = None
+        found = {unique[0]: driver_positions}
+        for t, cur in cursors.items():
+            positions = cur.seek(verse_id)
+            if positions is None:
+                break
+            found[t] = positions
+        else:
+            if any(len(found[t]) < n for t, n in repeated):
+                yield verse_id, None
+                continue
+            term_positions = [found[t] for t in terms]
+            if mode == "phrase":
+                starts = phrase_match(term_positions)
+                marked = {s + i for s in starts for i in range(len(terms))}
+            else:
+                windows = near_match(term_positions, distance)
+                marked = {p for plist in term_positions for p in plist
+                          if any(first <= p <= last for first, last in windows)}
+        yield verse_id, marked or None
+
+_checkpoints = OrderedDict()   # query -> {hits before: (translation index, verse id)}
+_checkpoints_lock = threading.Lock()
+
+def _checkpoint(key, skip):
+    """(hits before, translation index, verse id) of the furthest recorded
+    point of the walk for key that is not past hit number skip."""
+    with _checkpoints_lock:
+        marks = _checkpoints.get(key)
+        if marks:
+            _checkpoints.move_to_end(key)
+            before = max((n for n in marks if n <= skip), default=None)
+            if before is not None:
+                return (before,) + marks[before]
+    return 0, 0, None
+
+def _record(key, before, index, verse_id):
+    with _checkpoints_lock:
+        marks = _checkpoints.setdefault(key, {})
+        _checkpoints.move_to_end(key)
+        marks[before] = (index, verse_id)
+        if len(marks) > CHECKPOINTS_PER_QUERY:
+            del marks[next(iter(marks))]
+        if len(_checkpoints) > CHECKPOINT_QUERIES:
+            _checkpoints.popitem(last=False)
+
+# ---------------------------
+# Queries
+# ---------------------------
+
+def search(conn, query, mode="phrase", distance=DEFAULT_DISTANCE, translation=None, book=None,
+           page=1, per_page=20):
+    """Verses containing query as an exact phrase (mode "phrase") or with all
+    its words within distance words of each other (mode "near"). Same
+    (results, has_next) shape as search.search; results are in translation
+    and verse order. A search that walks MAX_SCAN verses without filling its
+    page stops there, with has_next False."""
+    terms = vocabulary.words(query)[:MAX_TERMS]
+    if not terms or mode not in MODES:
+        return [], False
+    if mode == "near" and len(set(terms)) < 2:
+        mode = "phrase"
+    distance = min(max(distance, 0), MAX_DISTANCE)
+    if mode == "near":
+        terms = list(dict.fromkeys(terms))
+    lo, hi = (db.pack_verse_id(book, 0, 0), db.pack_verse_id(book, 999, 999)) if book else (0, 99999999)
+    skip = (max(page, 1) - 1) * per_page
+    translations = [translation] if translation else db.TRANSLATIONS
+    key = (corpus_build()[0], tuple(terms), mode, distance, translation, book)
+
+    # Hits are counted from a checkpoint: seen is the number of hits before
+    # (translations[start], after), exclusive.
+    seen, start, after = _checkpoint(key, skip)
+    hits, scanned = [], 0
+    for index in range(start, len(translations)):
+        trans = translations[index]
+        first = after + 1 if after is not None and index == start else lo
+        for verse_id, marked in _matches(conn, trans, terms, mode, distance, first, hi):
+            scanned += 1
+            if marked is not None:
+                if seen < skip:
+                    seen += 1
+                else:
+                    hits.append((index, verse_id, marked))
+                    if len(hits) == per_page:
+                        _record(key, skip + per_page, index, verse_id)
+                    elif len(hits) > per_page:
+                        break
+            if scanned >= MAX_SCAN:
+                if len(hits) < per_page:
+                    _record(key, seen + len(hits), index, verse_id)
+                break
+        else:
+            continue
+        break
+
+    results = []
+    for index, verse_id, marked in hits[:per_page]:
+        trans = translations[index]
+        text = verse_text(conn, trans, verse_id)
+        b, c, v = db.unpack_verse_id(verse_id)
+        results.append({
+            "verse_id": verse_id,
+            "book": db.BOOK_NAMES.get(b, ""),
+            "chapter": c,
+            "verse": v,
+            "translation": trans,
+            "snippet": highlight(text, marked),
+        })
+    return results, len(hits) > per_page
+
+def verse_text(conn, translation, verse_id):
+    mapped = corpus.open_corpus(translation)
+    if mapped is not None:
+        row = mapped.verse(verse_id)
+        return row[4] if row else ""
+    row = conn.execute("SELECT text FROM verses WHERE translation = ? AND verse_id = ?",
+                       (translation, verse_id)).fetchone()
+    return row[0] if row else ""
+
+def highlight(text, marked):
+    """text with the words at the given token positions wrapped in <mark>."""
+    out, last = [], 0
+    for position, m in enumerate(vocabulary.WORD.finditer(text)):
+        if position in marked:
+            out.append(escape(text[last:m.start()]))
+            out.append(Markup("<mark>%s</mark>") % m.group())
+            last = m.end()
+    out.append(escape(text[last:]))
+    return Markup("").join(out)
@@ -0,0 +1,200 @@
+"""
+Scripture reference parsing, e.g. "Jn 3:16-18; Ps 23; 1 Cor 13:4-7".
+
+Book names come from csv/key_english.csv and the abbreviations from
+csv/key_abbreviations_english.csv. Every name, abbreviation and unambiguous
+name prefix is normalised into one lookup table when the module is imported,
+so resolving a book is a single dict hit.
+"""
+import csv
+import os
+import re
+from collections import namedtuple
+
+import db
+
+MAX_BATCH = 100
+MAX_VERSES = 5000
+
+Reference = namedtuple("Reference", "text start end")
+
+_ORDINALS = (
+    (re.compile(r"^(?:1st|first|i)\s+"), "1 "),
+    (re.compile(r"^(?:2nd|second|ii)\s+"), "2 "),
+    (re.compile(r"^(?:3rd|third|iii)\s+"), "3 "),
+    (re.compile(r"^([123])\s*(?=[a-z])"), r"\1 "),
+)
+_BOOK_AND_REST = re.compile(r"^\s*(?P<book>.*?[a-z.])\s*(?P<rest>\d[\d:,\-\s]*)?$", re.I)
+_REST_ONLY = re.compile(r"^\s*(?P<rest>\d[\d:,\-\s]*)$")
+_CHAPTER_VERSE = re.compile(r"^(\d+):(\d+)$")
+_SEPARATOR_SPACE = re.compile(r"\s*([:\-])\s*")
+
+# Obadiah, Philemon, 2 John, 3 John and Jude: "Jude 3" is verse 3.
+SINGLE_CHAPTER_BOOKS = frozenset((31, 57, 63, 64, 65))
+MAX_NUMBER = 999
+
+def normalize_book(name):
+    """Lower-case, drop periods, collapse spaces and spell leading ordinals
+    ("I Sam", "1st Samuel", "1Sam") as "1 sam"."""
+    key = " ".join(name.replace(".", " ").lower().split())
+    for pattern, repl in _ORDINALS:
+        key = pattern.sub(repl, key, count=1)
+    return key
+
+def _build_book_table():
+    table = {}
+    names = {}
+    for book_id, name, _, _ in db.BOOKS:
+        names[normalize_book(name)] = book_id
+    path = os.path.join(db.DATA_DIR, "csv", "key_abbreviations_english.csv")
+    with open(path, newline="") as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)
+        abbreviations = {normalize_book(abbr): int(book_id) for _, abbr, book_id, _ in reader}
+
+    # Prefixes of full names ("psalm", "revel") when only one book has them.
+    prefixes = {}
+    for key, book_id in names.items():
+        for i in range(2, len(key)):
+            prefixes.setdefault(key[:i], set()).add(book_id)
+    table.update((k, ids.pop()) for k, ids in prefixes.items() if len(ids) == 1)
+    table.update(abbreviations)
+    table.update(names)
+    return table
+
+BOOK_TABLE = _build_book_table()
+
+def lookup_book(name):
+    return BOOK_TABLE.get(normalize_book(name))
+
+# ---------------------------
+# Parsing
+# ---------------------------
+
+def parse(text):
+    """Parse a ';'-separated list of references into Reference tuples.
+
+    Later parts may omit the book ("Jn 3:16; 4:1") and comma lists continue
+    the previous chapter ("Jn 3:16,18"). Raises ValueError naming the part
+    that could not be read.
+    """
+    refs = []
+    book = None
+    for part in text.replace("–", "-").replace("—", "-").split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        m = _REST_ONLY.match(part) if book else None
+        if m is None:
+            m = _BOOK_AND_REST.match(part)
+            if m is None:
+                raise ValueError("Cannot read reference %r" % part)
+            book = lookup_book(m.group("book"))
+            if book is None:
+                raise ValueError("Unknown book in %r" % part)
+        rest = m.group("rest")
+        if not rest:
+            refs.append(Reference(part, db.pack_verse_id(book, 0, 0), db.pack_verse_id(book, 999, 999)))
+            continue
+        refs.extend(Reference(part, start, end) for start, end in _parse_spans(book, rest, part))
+    return refs
+
+def _number(text, part):
+    n = int(text)
+    if n > MAX_NUMBER:
+        raise ValueError("Number out of range in %r" % part)
+    return n
+
+def _parse_spans(book, rest, part):
+    chapter = None
+    verse_level = False
+    if book in SINGLE_CHAPTER_BOOKS and ":" not in rest:
+        chapter, verse_level = 1, True
+    for item in rest.split(","):
+        # Spaces may surround ":" and "-" but not split a number ("Jn 3 16").
+        item = _SEPARATOR_SPACE.sub(r"\1", item.strip())
+        if not item:
+            continue
+        if any(c.isspace() for c in item):
+            raise ValueError("Cannot read reference %r" % part)
+        first, _, last = item.partition("-")
+        m = _CHAPTER_VERSE.match(first)
+        if m:
+            chapter, verse_level = _number(m.group(1), part), True
+            start = db.pack_verse_id(book, chapter, _number(m.group(2), part))
+        elif first.isdigit() and verse_level:
+            start = db.pack_verse_id(book, chapter, _number(first, part))
+        elif first.isdigit():
+            chapter = _number(first, part)
+            start = db.pack_verse_id(book, chapter, 0)
+        else:
+            raise ValueError("Cannot read reference %r" % part)
+
+        if not last:
+            end = start if verse_level else db.pack_verse_id(book, chapter, 999)
+        else:
+            m = _CHAPTER_VERSE.match(last)
+            if m:
+                chapter = _number(m.group(1), part)
+                end = db.pack_verse_id(book, chapter, _number(m.group(2), part))
+            elif last.isdigit() and verse_level:
+                end = db.pack_verse_id(book, chapter, _number(last, part))
+            elif last.isdigit():
+                chapter = _number(last, part)
+                end = db.pack_verse_id(book, chapter, 999)
+            else:
+                raise ValueError("Cannot read reference %r" % part)
+        if end < start:
+            raise ValueError("Range runs backwards in %r" % part)
+        yield start, end
+
+def format_reference(start, end):
+    """Canonical text for a verse-id span, e.g. "John 3:16-18" or "Psalms 23"."""
+    b1, c1, v1 = db.unpack_verse_id(start)
+    b2, c2, v2 = db.unpack_verse_id(end)
+    name = db.BOOK_NAMES.get(b1, "?")
+    if v1 == 0 and v2 == 999:
+        if c1 == 0 and c2 == 999:
+            return name
+        return "%s %d" % (name, c1) if c1 == c2 else "%s %d-%d" % (name, c1, c2)
+    if b1 != b2:
+        return "%s %d:%d - %s %d:%d" % (name, c1, v1, db.BOOK_NAMES.get(b2, "?"), c2, v2)
+    if start == end:
+        return "%s %d:%d" % (name, c1, v1)
+    if c1 == c2:
+        return "%s %d:%d-%d" % (name, c1, v1, v2)
+    return "%s %d:%d-%d:%d" % (name, c1, v1, c2, v2)
+
+# ---------------------------
+# Batch resolution
+# ---------------------------
+
+def resolve(conn, translation, refs, limit=MAX_VERSES):
+    """Fetch the verses of every reference in one query, at most limit per
+    reference.
+
+    The spans are joined against verses as a VALUES table, so each one is an
+    index seek on (translation, verse_id) within a single statement; a span
+    longer than limit is first cut at its limit-th verse id (an OFFSET seek in
+    the same index). Returns one list of (verse_id, book, chapter, verse, text)
+    rows per reference.
+    """
+    results = [[] for _ in refs]
+    if not refs:
+        return results
+    values = ", ".join(["(?, ?, ?)"] * len(refs))
+    params = []
+    for i, ref in enumerate(refs):
+        params += [i, ref.start, ref.end]
+    sql = ("WITH spans(i, lo, hi) AS (VALUES %s), "
+           "capped(i, lo, hi) AS (SELECT i, lo, COALESCE((SELECT verse_id FROM verses "
+           "WHERE translation = ? AND verse_id BETWEEN lo AND hi ORDER BY verse_id LIMIT 1 OFFSET ?), hi) "
+           "FROM spans) "
+           "SELECT capped.i, v.verse_id, v.book, v.chapter, v.verse, v.text "
+           "FROM capped JOIN verses v ON v.translation = ? AND v.verse_id BETWEEN capped.lo AND capped.hi "
+           "ORDER BY capped.i, v.verse_id" % values)
+    if limit <= 0:
+        return results
+    for row in conn.execute(sql, params + [translation, limit - 1, translation]):
+        results[row[0]].append(row[1:])
+    return results
@@ -0,0 +1,277 @@
+"""
+Related verses: the K most similar verses of every verse in a translation,
+by cosine similarity of TF-IDF vectors.
+
+    python related.py                      # every translation, all cores
+    python related.py KJV --k 20 --redis   # also publish the arrays to Redis
+
+The batch job turns each translation into a sparse verse x term matrix
+(sublinear tf, smoothed idf, L2-normalised rows; words in more than MAX_DF
+of the verses or in only one verse are dropped) and multiplies it by its
+own transpose in blocks of BLOCK_ROWS verses spread over a process pool,
+keeping each verse's top K. NumPy and SciPy do the block products when
+they are installed (they are in requirements.txt); without them the same
+scores are summed from an inverted index in pure Python, which takes minutes
+per translation rather than seconds.
+
+Results go to <corpus dir>/<translation>.related (little-endian):
+
+    header      magic, verse count, k, build hash
+    ids         uint32 verse id of every verse, ascending
+    neighbours  uint32 verse ids, k per verse, most similar first (0 = none)
+    scores      float32 cosine similarity, k per verse
+
+and are read through mmap, so a lookup is a bisect and a slice.
+"""
+import argparse
+import heapq
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+
+import corpus
+import db
+import vocabulary
+from http_cache import corpus_build
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+MAGIC = b"BIBLREL1"
+HEADER = struct.Struct("<8sII16s")
+DEFAULT_K = 10
+MAX_DF = 0.2
+BLOCK_ROWS = 512
+
+def related_path(translation, corpus_dir=corpus.CORPUS_DIR):
+    return os.path.join(corpus_dir, "%s.related" % translation)
+
+# ---------------------------
+# Vectors
+# ---------------------------
+
+def tfidf_rows(texts, max_df=MAX_DF):
+    """One [(term index, weight)] list per text, each L2-normalised."""
+    counted = []
+    df = {}
+    for text in texts:
+        tf = {}
+        for word in vocabulary.words(text):
+            tf[word] = tf.get(word, 0) + 1
+        counted.append(tf)
+        for word in tf:
+            df[word] = df.get(word, 0) + 1
+
+    n = len(texts)
+    kept = sorted(word for word, d in df.items() if 1 < d <= max_df * n)
+    columns = {word: i for i, word in enumerate(kept)}
+    idf = {word: math.log((1 + n) / (1 + df[word])) + 1 for word in kept}
+
+    rows = []
+    for tf in counted:
+        row = [(columns[w], (1 + math.log(c)) * idf[w]) for w, c in tf.items() if w in columns]
+        norm = math.sqrt(sum(weight * weight for _, weight in row)) or 1.0
+        rows.append(sorted((i, weight / norm) for i, weight in row))
+    return rows, len(kept)
+
+# ---------------------------
+# Top-k blocks (run in the pool)
+# ---------------------------
+
+_state = {}
+
+def _init_numpy(indptr, indices, data, columns, k):
+    m = sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, columns))
+    _state.update(matrix=m, transposed=m.T.tocsc(), k=k)
+
+def _block_numpy(start):
+    m, k = _state["matrix"], _state["k"]
+    stop = min(start + BLOCK_ROWS, m.shape[0])
+    rows = np.arange(stop - start)
+    scores = (m[start:stop] @ _state["transposed"]).toarray()
+    scores[rows, rows + start] = 0.0
+    top = np.argpartition(-scores, k, axis=1)[:, :k]
+    best = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-best, axis=1, kind="stable")
+    neighbours = np.take_along_axis(top, order, axis=1)
+    best = np.take_along_axis(best, order, axis=1)
+    neighbours[best <= 0] = -1
+    return start, neighbours.tolist(), best.tolist()
+
+def _init_python(rows, k):
+    index = {}
+    for r, row in enumerate(rows):
+        for i, weight in row:
+            index.setdefault(i, []).append((r, weight))
+    _state.update(rows=rows, index=index, k=k)
+
+def _block_python(start):
+    rows, index, k = _state["rows"], _state["index"], _state["k"]
+    stop = min(start + BLOCK_ROWS, len(rows))
+    neighbours, best = [], []
+    for r in range(start, stop):
+        scores = {}
+        for i, weight in rows[r]:
+            for other, w in index[i]:
+                scores[other] = scores.get(other, 0.0) + weight * w
+        scores.pop(r, None)
+        top = heapq.nsmallest(k, scores.items(), key=lambda item: (-item[1], item[0]))
+        neighbours.append([other for other, _ in top] + [-1] * (k - len(top)))
+        best.append([score for _, score in top] + [0.0] * (k - len(top)))
+    return start, neighbours, best
+
+def top_k(rows, columns, k=DEFAULT_K, workers=None):
+    """(neighbour row lists, score lists): each row's k most similar other
+    rows, -1 padded."""
+    if np is not None:
+        indptr, indices, data = [0], [], []
+        for row in rows:
+            indices += [i for i, _ in row]
+            data += [weight for _, weight in row]
+            indptr.append(len(indices))
+        init, block = _init_numpy, _block_numpy
+        initargs = (np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int32),
+                    np.array(data, dtype=np.float32), columns, k)
+    else:
+        init, block, initargs = _init_python, _block_python, (rows, k)
+
+    neighbours, scores = [None] * len(rows), [None] * len(rows)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init, initargs=initargs) as pool:
+        for start, block_neighbours, block_scores in pool.map(block, range(0, len(rows), BLOCK_ROWS)):
+            neighbours[start:start + len(block_neighbours)] = block_neighbours
+            scores[start:start + len(block_scores)] = block_scores
+    return neighbours, scores
+
+# ---------------------------
+# Build
+# ---------------------------
+
+def build(conn, translation, path, k=DEFAULT_K, workers=None, build_hash=""):
+    """Compute and write the related-verses file of one translation; returns
+    (verse ids, neighbour verse ids, scores) as flat arrays."""
+    verses = conn.execute("SELECT verse_id, text FROM verses WHERE translation = ? ORDER BY verse_id",
+                          (translation,)).fetchall()
+    ids = array("I", (verse_id for verse_id, _ in verses))
+    rows, columns = tfidf_rows([text for _, text in verses])
+    neighbour_rows, score_rows = top_k(rows, columns, k, workers)
+
+    neighbours, scores = array("I"), array("f")
+    for found, best in zip(neighbour_rows, score_rows):
+        neighbours.extend(ids[i] if i >= 0 else 0 for i in found)
+        scores.extend(best)
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(ids), k, build_hash.encode("ascii")[:16]))
+        ids.tofile(f)
+        neighbours.tofile(f)
+        scores.tofile(f)
+    os.replace(tmp, path)
+    return ids, neighbours, scores
+
+def publish(translation, ids, neighbours, scores, k):
+    """Store the arrays in Redis (related:<translation>:ids|neighbours|scores)."""
+    from redis_client import RedisConnection
+    conn = RedisConnection(decode_responses=False)
+    conn.set_np_array("related:%s:ids" % translation, np.frombuffer(ids, dtype=np.uint32).reshape(1, -1))
+    conn.set_np_array("related:%s:neighbours" % translation, np.frombuffer(neighbours, dtype=np.uint32).reshape(-1, k))
+    conn.set_np_array("related:%s:scores" % translation, np.frombuffer(scores, dtype=np.float32).reshape(-1, k))
+
+# ---------------------------
+# Read
+# ---------------------------
+
+class Related(object):
+    """Read-only view of one translation's related-verses file."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, k, build_hash = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a related-verses file" % path)
+        self.count, self.k = count, k
+        self.build_hash = build_hash.rstrip(b"\0").decode("ascii")
+
+        view = memoryview(self.mm)
+        pos = HEADER.size
+        self.ids = view[pos:pos + 4 * count].cast("I")
+        pos += 4 * count
+        self.neighbours = view[pos:pos + 4 * count * k].cast("I")
+        pos += 4 * count * k
+        self.scores = view[pos:pos + 4 * count * k].cast("f")
+
+    def related(self, verse_id, limit=None):
+        """[(verse_id, score)] most similar first; None for unknown verses."""
+        i = bisect_left(self.ids, verse_id)
+        if i >= self.count or self.ids[i] != verse_id:
+            return None
+        lo = i * self.k
+        hi = lo + min(max(self.k if limit is None else limit, 0), self.k)
+        return [(n, s) for n, s in zip(self.neighbours[lo:hi], self.scores[lo:hi]) if n]
+
+    def close(self):
+        self.ids.release()
+        self.neighbours.release()
+        self.scores.release()
+        self.mm.close()
+
+_open = {}
+
+def open_related(translation, corpus_dir=corpus.CORPUS_DIR):
+    """The per-process Related for translation, mapped on first use; None if
+    related.py has not been run for it since the corpus was last ingested."""
+    build_hash = (corpus_build()[0] or "")[:16]
+    key = (corpus_dir, translation, build_hash)
+    if key not in _open:
+        path = related_path(translation, corpus_dir)
+        if not translation.isalnum() or not os.path.exists(path):
+            return None
+        rel = Related(path)
+        if rel.build_hash != build_hash:
+            rel.close()
+            return None
+        for stale in [k for k in _open if k[:2] == key[:2]]:
+            _open.pop(stale).close()
+        _open[key] = rel
+    return _open[key]
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute related verses by TF-IDF similarity.")
+    parser.add_argument("translations", nargs="*", help="translations to process (default: all)")
+    parser.add_argument("--db", default=db.CORPUS_DATABASE, help="corpus database file (default: %(default)s)")
+    parser.add_argument("--out", default=corpus.CORPUS_DIR, help="output folder (default: %(default)s)")
+    parser.add_argument("--k", type=int, default=DEFAULT_K, help="neighbours per verse")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: CPU count)")
+    parser.add_argument("--redis", action="store_true", help="also store the arrays in Redis (needs NumPy)")
+    args = parser.parse_args()
+    if args.redis and np is None:
+        parser.error("--redis needs NumPy")
+    if np is None:
+        print("NumPy/SciPy not found (pip install -r requirements.txt); using the much slower pure-Python path.")
+
+    conn = sqlite3.connect(args.db)
+    row = conn.execute("SELECT value FROM corpus_meta WHERE key = 'build_hash'").fetchone()
+    translations = args.translations or [t for (t,) in conn.execute("SELECT DISTINCT translation FROM verses")]
+    os.makedirs(args.out, exist_ok=True)
+    for translation in translations:
+        started = time.time()
+        ids, neighbours, scores = build(conn, translation, related_path(translation, args.out), args.k,
+                                        args.workers, row[0] if row else "")
+        if args.redis:
+            publish(translation, ids, neighbours, scores, args.k)
+        print("%s: %d verses in %.1fs (%s)" % (translation, len(ids), time.time() - started,
+                                             "scipy" if np is not None else "pure Python"))
+    conn.close()
+
+if __name__ == "__main__":
+    main()
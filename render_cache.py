@@ -0,0 +1,149 @@
+"""
+In-process cache of rendered pages, bounded by size with LRU eviction.
+
+Entries are keyed by (template, translation, book, chapter, page, ...) and
+scoped to the corpus build hash: when the build changes, every entry from
+the old build is dropped. An optional L2 store lets workers share renders,
+either a SQLite file (SQLiteStore) or Redis through RedisConnection
+(RedisStore).
+"""
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+class SQLiteStore(object):
+    """Shared L2 in a SQLite file, safe to open from several workers."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS render_cache (key TEXT PRIMARY KEY, build TEXT, value BLOB)")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute("SELECT value FROM render_cache WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, build, value):
+        try:
+            with self._conn() as conn:
+                conn.execute("INSERT OR REPLACE INTO render_cache (key, build, value) VALUES (?, ?, ?)",
+                             (key, build, value))
+        except sqlite3.OperationalError:
+            # Another worker holds the write lock; the page is cached in L1 anyway.
+            pass
+
+    def purge(self, build):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM render_cache WHERE build != ?", (build,))
+
+class RedisStore(object):
+    """Shared L2 in Redis through a RedisConnection (reads replica, writes main)."""
+
+    def __init__(self, connection, ttl=86400, prefix="render_cache:"):
+        self.connection = connection
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.connection.get_by_key(self.prefix + key)
+
+    def set(self, key, build, value):
+        self.connection.main.set(self.prefix + key, value, ex=self.ttl)
+
+    def purge(self, build):
+        # Keys embed the build hash, so stale renders simply expire.
+        pass
+
+class RenderCache(object):
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, l2=None):
+        self.max_bytes = max_bytes
+        self.l2 = l2
+        self.build = None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.l2_hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def make_key(build, parts):
+        return hashlib.sha1(("%s|%s" % (build, "|".join(map(str, parts)))).encode()).hexdigest()
+
+    def set_build(self, build):
+        """Drop everything cached for another corpus build."""
+        with self._lock:
+            if build == self.build:
+                return
+            self._entries.clear()
+            self._bytes = 0
+            self.build = build
+        if self.l2 is not None:
+            self.l2.purge(build)
+
+    def get(self, parts):
+        key = self.make_key(self.build, parts)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value.decode("utf-8")
+        if self.l2 is not None:
+            value = self.l2.get(key)
+            if value is not None:
+                if isinstance(value, str):
+                    value = value.encode("utf-8")
+                self.l2_hits += 1
+                self._store(key, value)
+                return value.decode("utf-8")
+        self.misses += 1
+        return None
+
+    def put(self, parts, html):
+        key = self.make_key(self.build, parts)
+        value = html.encode("utf-8")
+        self._store(key, value)
+        if self.l2 is not None:
+            self.l2.set(key, self.build, value)
+
+    def _store(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = value
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.l2_hits + self.misses
+        return {
+            "build": self.build,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "l2_hits": self.l2_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.l2_hits) / lookups, 4) if lookups else 0.0,
+        }
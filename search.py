@@ -0,0 +1,99 @@
+import re
+
+from markupsafe import Markup, escape
+
+import db
+import vocabulary
+
+PER_PAGE = 20
+SNIPPET_TOKENS = 32
+
+# Private-use markers that cannot occur in the corpus; snippets are escaped
+# first and the markers swapped for <mark> afterwards.
+_OPEN, _CLOSE = "\ue000", "\ue001"
+QUERY_TERM = re.compile(r"[\w']+\*?")
+
+# ---------------------------
+# Index
+# ---------------------------
+
+def build_index(conn):
+    """(Re)build the FTS5 index over verses.text; translation is an indexed
+    column so translation filters are resolved inside the MATCH."""
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS verses_fts USING fts5(
+        text,
+        translation,
+        content='verses',
+        content_rowid='id',
+        tokenize='porter unicode61 remove_diacritics 2'
+    )
+    """)
+    conn.execute("INSERT INTO verses_fts(verses_fts) VALUES('rebuild')")
+
+def has_index(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'verses_fts'").fetchone() is not None
+
+# ---------------------------
+# Queries
+# ---------------------------
+
+def match_expression(query, translation=None, expansions=None):
+    """Turn free text into an FTS5 expression: every word must match, a
+    trailing * keeps prefix matching, everything else is quoted literally.
+    expansions ({word: [alternatives]}, see fuzzy.expand) lets a word match
+    any of its alternatives instead."""
+    expansions = expansions or {}
+    terms = []
+    for term in QUERY_TERM.findall(query):
+        prefix = term.endswith("*")
+        term = term.rstrip("*").replace('"', "")
+        alternatives = [] if prefix else expansions.get(vocabulary.fold(term), [])
+        if alternatives:
+            words = dict.fromkeys([term] + alternatives)
+            terms.append("(%s)" % " OR ".join('"%s"' % w.replace('"', "") for w in words))
+        elif term:
+            terms.append('"%s"%s' % (term, "*" if prefix else ""))
+    if not terms:
+        return None
+    expression = "text : (%s)" % " AND ".join(terms)
+    if translation:
+        expression += ' AND translation : "%s"' % translation.replace('"', "")
+    return expression
+
+def search(conn, query, translation=None, book=None, page=1, per_page=PER_PAGE, expansions=None):
+    """BM25-ranked matches for query, optionally limited to a translation and
+    book. Returns (results, has_next); each result is a dict with the verse
+    reference and a highlighted, HTML-safe snippet."""
+    expression = match_expression(query, translation, expansions)
+    if expression is None:
+        return [], False
+
+    sql = """
+    SELECT v.verse_id, v.book, v.chapter, v.verse, v.translation,
+           snippet(verses_fts, 0, ?, ?, '…', ?)
+    FROM verses_fts
+    JOIN verses v ON v.id = verses_fts.rowid
+    WHERE verses_fts MATCH ?
+    """
+    params = [_OPEN, _CLOSE, SNIPPET_TOKENS, expression]
+    if book is not None:
+        sql += " AND v.verse_id BETWEEN ? AND ?"
+        params += [db.pack_verse_id(book, 0, 0), db.pack_verse_id(book, 999, 999)]
+    sql += " ORDER BY bm25(verses_fts, 1.0, 0.0) LIMIT ? OFFSET ?"
+    params += [per_page + 1, (max(page, 1) - 1) * per_page]
+
+    rows = conn.execute(sql, params).fetchall()
+    results = [{
+        "verse_id": verse_id,
+        "book": book_name,
+        "chapter": chapter,
+        "verse": verse,
+        "translation": trans,
+        "snippet": highlight(snippet),
+    } for verse_id, book_name, chapter, verse, trans, snippet in rows[:per_page]]
+    return results, len(rows) > per_page
+
+def highlight(snippet):
+    return Markup(str(escape(snippet)).replace(_OPEN, "<mark>").replace(_CLOSE, "</mark>"))
@@ -1,37 +1,32 @@
-const CACHE_NAME = 'bible-app-cache-v3';
-const urlsToCache = [
-  '/',
-  '/verses/KJV',
-  '/verses/WEB',
-  '/static/css/style.css',
-  '/static/js/app.js',
-  '/offline'   // ✅ offline page route
+// Offline reading.
+//
+// The app shell is re-fetched on every install, so it needs no hand-bumped
+// cache name. Bible text comes from the server-built bundles listed in
+// /offline/manifest.json: one gzip JSON file per translation and book, named
+// by its content hash. A sync compares the manifest with the bundle cache and
+// downloads only the books whose text changed.
+const SHELL_CACHE = 'bible-shell';
+const BUNDLE_CACHE = 'bible-bundles';
+const MANIFEST_URL = '/offline/manifest.json';
+const shellUrls = [
+  '/offline',
+  '/static/style.css',
+  '/static/manifest.json'
 ];
+const offlineTranslations = ['KJV', 'WEB'];
 
 // Install event
 self.addEventListener('install', event => {
   event.waitUntil(
-    caches.open(CACHE_NAME).then(cache => {
-      return cache.addAll(urlsToCache);
-    })
-  );
-});
-
-// Fetch event
-self.addEventListener('fetch', event => {
-  event.respondWith(
-    fetch(event.request).catch(() => {
-      // If request fails, show offline page
-      return caches.match(event.request).then(response => {
-        return response || caches.match('/offline');
-      });
-    })
+    caches.open(SHELL_CACHE).then(cache => {
+      return cache.addAll(shellUrls.map(url => new Request(url, { cache: 'reload' })));
+    }).then(() => self.skipWaiting())
   );
 });
 
 // Activate event
 self.addEventListener('activate', event => {
-  const cacheWhitelist = [CACHE_NAME];
+  const cacheWhitelist = [SHELL_CACHE, BUNDLE_CACHE];
   event.waitUntil(
     caches.keys().then(keyList => {
       return Promise.all(
@@ -41,6 +36,132 @@ self.addEventListener('activate', event => {
           }
         })
       );
-    })
+    }).then(() => self.clients.claim()).then(syncBundles)
   );
 });
+
+// Pages can ask for a sync, e.g. on every load: postMessage('sync-bundles')
+self.addEventListener('message', event => {
+  if (event.data === 'sync-bundles') {
+    event.waitUntil(syncBundles());
+  }
+});
+
+async function syncBundles() {
+  let response;
+  try {
+    response = await fetch(MANIFEST_URL, { cache: 'no-cache' });
+  } catch (err) {
+    return;
+  }
+  if (!response.ok) {
+    return;
+  }
+  const manifest = await response.clone().json();
+  const cache = await caches.open(BUNDLE_CACHE);
+
+  const wanted = new Set();
+  for (const translation of offlineTranslations) {
+    for (const entry of Object.values(manifest.bundles[translation] || {})) {
+      wanted.add(`/offline/bundles/${translation}/${entry.file}`);
+    }
+  }
+  const cached = new Set((await cache.keys()).map(request => new URL(request.url).pathname));
+  const missing = [...wanted].filter(url => !cached.has(url));
+  for (let i = 0; i < missing.length; i += 6) {
+    await cache.addAll(missing.slice(i, i + 6));
+  }
+
+  // Only point at the new bundles once they are all here.
+  await cache.put(MANIFEST_URL, response);
+  await Promise.all([...cached]
+    .filter(url => url !== MANIFEST_URL && !wanted.has(url))
+    .map(url => cache.delete(url)));
+}
+
+// Fetch event
+self.addEventListener('fetch', event => {
+  const url = new URL(event.request.url);
+  if (event.request.method !== 'GET' || url.origin !== self.location.origin) {
+    return;
+  }
+  if (url.pathname.startsWith('/offline/bundles/')) {
+    // Content-hashed: a cached copy is always current.
+    event.respondWith(caches.match(event.request).then(response => response || fetch(event.request)));
+    return;
+  }
+  event.respondWith(fetch(event.request).catch(() => offlineResponse(event.request, url)));
+});
+
+async function offlineResponse(request, url) {
+  const cached = await caches.match(request);
+  if (cached) {
+    return cached;
+  }
+  const m = url.pathname.match(/^\/verses\/([^/]+)\/([^/]+)\/(\d+)$/);
+  if (m) {
+    const page = await chapterPage(decodeURIComponent(m[1]), decodeURIComponent(m[2]), Number(m[3]));
+    if (page) {
+      return page;
+    }
+  }
+  // If nothing is cached, show offline page
+  return (await caches.match('/offline')) || Response.error();
+}
+
+async function chapterPage(translation, book, chapter) {
+  const manifestResponse = await caches.match(MANIFEST_URL);
+  if (!manifestResponse) {
+    return null;
+  }
+  const books = (await manifestResponse.json()).bundles[translation] || {};
+  const bookId = books[book] ? book : Object.keys(books).find(
+    id => books[id].name.toLowerCase() === book.toLowerCase());
+  if (!bookId) {
+    return null;
+  }
+  const bundleResponse = await caches.match(`/offline/bundles/${translation}/${books[bookId].file}`);
+  if (!bundleResponse) {
+    return null;
+  }
+  const bundle = await bundleResponse.json();
+  const verses = bundle.chapters[chapter - 1];
+  if (!verses || !verses.length) {
+    return null;
+  }
+
+  const title = `${escapeHtml(bundle.name)} ${chapter} - ${escapeHtml(translation)}`;
+  const items = verses.map(([verse, text]) =>
+    `<li id="v${verse}"><sup>${verse}</sup> ${escapeHtml(text)}</li>`).join('\n');
+  const links = [];
+  if (chapter > 1) {
+    links.push(`<a href="/verses/${translation}/${bookId}/${chapter - 1}">&laquo; Previous chapter</a>`);
+  }
+  if (chapter < bundle.chapters.length) {
+    links.push(`<a href="/verses/${translation}/${bookId}/${chapter + 1}">Next chapter &raquo;</a>`);
+  }
+  const html = `<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <meta name="viewport" content="width=device-width, initial-scale=1.0">
+  <link rel="stylesheet" href="/static/style.css">
+  <title>${title} | Bible App</title>
+</head>
+<body class="container mt-4">
+  <p><em>Offline copy</em> | <a href="/offline">Offline help</a></p>
+  <h1>${title}</h1>
+  <ol class="list-unstyled">
+${items}
+  </ol>
+  <p class="mt-3">${links.join(' | ')}</p>
+</body>
+</html>`;
+  return new Response(html, { headers: { 'Content-Type': 'text/html; charset=utf-8' } });
+}
+
+function escapeHtml(text) {
+  return String(text).replace(/[&<>"']/g, c => ({
+    '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+  })[c]);
+}
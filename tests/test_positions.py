@@ -0,0 +1,39 @@
+import positions
+
+def test_phrase_match():
+    assert positions.phrase_match([[0, 4], [1, 7], [2]]) == [0]
+    assert positions.phrase_match([[0, 5], [6]]) == [5]
+    assert positions.phrase_match([[0], [2]]) == []
+
+def test_near_match_two_terms():
+    assert positions.near_match([[0], [1]], 0) == [(0, 1)]
+    assert positions.near_match([[0], [2]], 0) == []
+    assert positions.near_match([[0], [6]], 5) == [(0, 6)]
+    assert positions.near_match([[0], [7]], 5) == []
+    assert positions.near_match([[6], [0]], 5) == [(0, 6)]
+
+def test_near_match_three_terms():
+    assert positions.near_match([[0], [1], [2]], 0) == [(0, 2)]
+    assert positions.near_match([[2], [0], [1]], 0) == [(0, 2)]
+    assert positions.near_match([[0], [1], [3]], 0) == []
+    assert positions.near_match([[0], [3], [6]], 5) == [(0, 6)]
+    assert positions.near_match([[0], [3], [8]], 5) == []
+
+def test_encode_decode_round_trip():
+    entries = [(1001001 + 3 * i, [i % 5, i % 5 + 2] if i % 2 else [i % 7])
+               for i in range(positions.BLOCK * 2 + 5)]
+    data, skips = positions.encode(entries)
+    postings = positions.Postings(len(entries), data.tobytes(), skips.tobytes())
+    assert len(postings.block_ids) == 3
+    assert list(postings) == entries
+    boundary = entries[positions.BLOCK][0]
+    assert next(postings.iter_from(boundary)) == entries[positions.BLOCK]
+
+def test_cursor_seeks_across_blocks():
+    entries = [(10 * i + 10, [i]) for i in range(positions.BLOCK * 3)]
+    data, skips = positions.encode(entries)
+    cursor = positions.Postings(len(entries), data.tobytes(), skips.tobytes()).cursor()
+    assert cursor.seek(10) == [0]
+    assert cursor.seek(15) is None
+    assert cursor.seek(10 * positions.BLOCK + 10) == [positions.BLOCK]
+    assert cursor.seek(10 * 3 * positions.BLOCK) == [3 * positions.BLOCK - 1]
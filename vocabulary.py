@@ -0,0 +1,69 @@
+"""
+Corpus vocabulary: the word tokenizer shared by the indexes built at ingest,
+and per-translation term counts in the vocabulary table of corpus.db.
+
+Words are runs of letters (apostrophes inside a word are kept, so "God's"
+is one word), lower-cased with diacritics removed. Unlike the FTS5 index
+nothing is stemmed, so the terms are real words that can be shown back to
+the user.
+"""
+import re
+import unicodedata
+from collections import Counter
+
+import db
+
+WORD = re.compile(r"[^\W\d_]+(?:['’][^\W\d_]+)*")
+
+def fold(text):
+    """Lower-case text and strip diacritics."""
+    if text.isascii():
+        return text.lower()
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c)).replace("’", "'")
+
+def words(text):
+    return WORD.findall(fold(text))
+
+def count_words(texts):
+    """(occurrences, verses containing it) per term over a list of verse texts."""
+    counts, verses = Counter(), Counter()
+    for text in texts:
+        found = words(text)
+        counts.update(found)
+        verses.update(set(found))
+    return counts, verses
+
+def build(conn, map=map, translations=None):
+    """Recount the vocabulary table from the verses table. Each translation
+    is counted by one call of map (ingest passes its process pool's); with
+    translations, only those are recounted unless the table is new."""
+    if not has_vocabulary(conn):
+        translations = None
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS vocabulary (
+        translation TEXT NOT NULL,
+        term TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        verses INTEGER NOT NULL,
+        PRIMARY KEY (translation, term)
+    ) WITHOUT ROWID
+    """)
+    where, params = db.translation_filter(translations)
+    conn.execute("DELETE FROM vocabulary" + where, params)
+    texts = {}
+    for translation, text in conn.execute("SELECT translation, text FROM verses" + where, params):
+        texts.setdefault(translation, []).append(text)
+    for translation, (counts, verses) in zip(texts, map(count_words, texts.values())):
+        conn.executemany("INSERT INTO vocabulary (translation, term, count, verses) VALUES (?, ?, ?, ?)",
+                         ((translation, term, n, verses[term]) for term, n in counts.items()))
+
+def has_vocabulary(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'vocabulary'").fetchone() is not None
+
+def term_counts(conn, translation=None):
+    """{term: occurrences} for one translation, or summed over all of them."""
+    if translation:
+        return dict(conn.execute("SELECT term, count FROM vocabulary WHERE translation = ?", (translation,)))
+    return dict(conn.execute("SELECT term, SUM(count) FROM vocabulary GROUP BY term"))